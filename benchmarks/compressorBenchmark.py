@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+
+import argparse
+import time
+import sys
+import os
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.mastering import compress
+from lib.mastering.audioIO import toSegment
+
+
+def makeSignal(duration: float, rate: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    t = np.arange(int(duration * rate)) / rate
+    envelope = 0.1 + 0.8 * (np.sin(2 * np.pi * 0.25 * t) > 0)
+    data = envelope[:, None] * np.sin(2 * np.pi * np.array([220, 330]) * t[:, None]) + 0.01 * rng.standard_normal((t.size, 2))
+    return data.astype(np.float32)
+
+
+def main():
+    args_parser = argparse.ArgumentParser(prog='compressorBenchmark.py', description='Compares the NumPy compressor with pydub compress_dynamic_range')
+    args_parser.add_argument('-d', '--duration', type=float, default=300, help='Signal length in seconds')
+    args_parser.add_argument('-r', '--rate', type=int, default=44100)
+    args = args_parser.parse_args()
+
+    params = {'threshold': -20.0, 'ratio': 4.0, 'attack': 5.0, 'release': 50.0}
+    data = makeSignal(args.duration, args.rate)
+
+    started = time.perf_counter()
+    compress(data, args.rate, **params)
+    numpy_time = time.perf_counter() - started
+
+    segment = toSegment(data, args.rate)
+    started = time.perf_counter()
+    segment.compress_dynamic_range(**params)
+    pydub_time = time.perf_counter() - started
+
+    print(f'{args.duration:.0f} s stereo at {args.rate} Hz')
+    print(f'pydub compress_dynamic_range: {pydub_time:.2f} s')
+    print(f'NumPy compress:               {numpy_time:.2f} s')
+    print(f'Speedup:                      {pydub_time / numpy_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import argparse
+import time
+import sys
+import os
+
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.mastering import audioProcessorUtils as apu
+
+
+def legacySmoothLowess(fft_data: np.ndarray, frac = 0.0375, delta = 0.001) -> np.ndarray:
+    import statsmodels.api as sm
+    return sm.nonparametric.lowess(fft_data, np.linspace(0, 1, len(fft_data)), frac=frac, it=0, delta=delta)[:, 1]
+
+
+def makePieces(quantity: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    spectrum = np.fft.rfft(rng.standard_normal((quantity, 44100 * 15)), axis=1)
+    spectrum /= np.sqrt(np.arange(1, spectrum.shape[1] + 1)) # pink-ish tilt
+    return np.fft.irfft(spectrum, axis=1)
+
+
+def measure(func, repeat: int) -> (np.ndarray, float):
+    result = func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return result, (time.perf_counter() - started) / repeat
+
+
+def main():
+    args_parser = argparse.ArgumentParser(prog='firBenchmark.py', description='Compares the FIR design with the statsmodels lowess it replaced')
+    args_parser.add_argument('-n', '--repeat', type=int, default=20, help='Timed FIR designs per implementation')
+    args_parser.add_argument('-t', '--tolerance', type=float, default=1e-6, help='Largest allowed FIR difference relative to the FIR peak')
+    args = args_parser.parse_args()
+
+    targ_average_fft = apu.averageFFT(makePieces(4, 0))
+    ref_average_fft = apu.averageFFT(makePieces(4, 1) * np.linspace(0.5, 1.5, 44100 * 15))
+
+    # The first call of the new implementation also builds the cached lowess matrix, grids and window
+    started = time.perf_counter()
+    apu.getMatchingFIR(targ_average_fft, ref_average_fft)
+    setup_time = time.perf_counter() - started
+
+    fir, new_time = measure(lambda: apu.getMatchingFIR(targ_average_fft, ref_average_fft), args.repeat)
+    with mock.patch.object(apu, 'smoothLowess', legacySmoothLowess):
+        legacy_fir, legacy_time = measure(lambda: apu.getMatchingFIR(targ_average_fft, ref_average_fft), args.repeat)
+
+    deviation = np.max(np.abs(fir - legacy_fir)) / np.max(np.abs(legacy_fir))
+
+    print(f'statsmodels lowess FIR: {legacy_time * 1000:.1f} ms')
+    print(f'Sparse matrix FIR:      {new_time * 1000:.1f} ms (first call {setup_time * 1000:.0f} ms)')
+    print(f'Speedup:                {legacy_time / new_time:.1f}x')
+    print(f'Relative FIR deviation: {deviation:.2e} (tolerance {args.tolerance:.0e})')
+
+    if deviation > args.tolerance:
+        sys.exit('FIR deviates from the statsmodels implementation beyond tolerance')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+import statistics
+import tracemalloc
+import argparse
+import tempfile
+import time
+import sys
+import os
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.mastering import readAudio, writeAudio
+from lib.mastering.streaming import readBlocks
+
+
+def measure(func, repeat: int) -> (object, float, int):
+    result = func()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+
+    # Peak of the memory allocated during one run, numpy reports its buffers to tracemalloc and mapped pages are not counted
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, statistics.median(times), peak
+
+
+def readWhole(path: str) -> np.ndarray:
+    return sf.read(path, dtype='float32', always_2d=True)[0]
+
+
+def sumBlocks(path: str, block_size: int, mapped: bool) -> np.ndarray:
+    with sf.SoundFile(path) as source:
+        blocks = readBlocks(source, block_size) if mapped else source.blocks(block_size, dtype='float32', always_2d=True)
+        return sum(np.sum(block, axis=0, dtype=np.float64) for block in blocks)
+
+
+def decoded(path: str) -> np.ndarray:
+    return sf.read(path, dtype='int16', always_2d=True)[0]
+
+
+def main():
+    args_parser = argparse.ArgumentParser(prog='ioBenchmark.py', description='Compares memory-mapped WAV I/O with libsndfile reads and writes')
+    args_parser.add_argument('-d', '--duration', type=float, default=600, help='Signal length in seconds')
+    args_parser.add_argument('-n', '--repeat', type=int, default=3, help='Timed runs per case')
+    args_parser.add_argument('-b', '--block-size', type=int, default=262144, help='Frames per block of the streaming read')
+    args = args_parser.parse_args()
+
+    rate = 44100
+    rng = np.random.default_rng(0)
+    data = (0.3 * rng.standard_normal((int(args.duration * rate), 2))).astype(np.float32)
+
+    failed = []
+    print(f'{"case":<22} {"soundfile s":>12} {"mapped s":>9} {"soundfile MB":>13} {"mapped MB":>10}')
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source.wav')
+        sf.write(source, data, rate, subtype='FLOAT', format='RF64')
+        source_16 = os.path.join(directory, 'source16.wav')
+        sf.write(source_16, data, rate, subtype='PCM_16')
+        old_output, new_output = os.path.join(directory, 'soundfile.wav'), os.path.join(directory, 'mapped.wav')
+
+        cases = {
+            'read float WAV': (lambda: readWhole(source), lambda: readAudio(source)[0]),
+            'write PCM_16 WAV': (lambda: sf.write(old_output, np.clip(data, -1.0, 1.0), rate), lambda: writeAudio(new_output, data, rate)),
+            'stream float WAV': (lambda: sumBlocks(source, args.block_size, False), lambda: sumBlocks(source, args.block_size, True)),
+            'read PCM_16 WAV': (lambda: readWhole(source_16), lambda: readAudio(source_16)[0]),
+            'stream PCM_16 WAV': (lambda: sumBlocks(source_16, args.block_size, False), lambda: sumBlocks(source_16, args.block_size, True))
+        }
+
+        for name, (old, new) in cases.items():
+            old_result, old_time, old_memory = measure(old, args.repeat)
+            new_result, new_time, new_memory = measure(new, args.repeat)
+
+            if name.startswith('write'):
+                old_result, new_result = decoded(old_output), decoded(new_output)
+            if not np.array_equal(old_result, new_result):
+                failed.append(f'{name}: mapped result differs from soundfile')
+            print(f'{name:<22} {old_time:>12.3f} {new_time:>9.3f} {old_memory / 1024**2:>13.1f} {new_memory / 1024**2:>10.1f}')
+
+    if failed:
+        sys.exit('\n'.join(failed))
+
+
+if __name__ == '__main__':
+    main()
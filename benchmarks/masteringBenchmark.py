@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+import statistics
+import platform
+import argparse
+import tempfile
+import logging
+import time
+import json
+import sys
+import os
+
+import numpy as np
+import soundfile as sf
+import scipy
+import toml
+import trio
+import asks
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.mastering import equalizeFile, compressFile, normalizeFile, byReference
+from lib.mastering import audioProcessorUtils as apu
+
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+equalization_params = {100: 3, 1000: -2, 8000: 4}
+compression_params = {'threshold': -20.0, 'ratio': 4.0, 'attack': 5.0, 'release': 50.0}
+normalization_params = {'dBFS': -14}
+
+
+def makeSignal(duration: float, rate: int, seed: int, noise: float = 0.02) -> np.ndarray:
+    # Deterministic music-like stereo signal: a few partials, a slow loudness envelope and some noise
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * rate)) / rate
+    partials = sum(np.sin(2 * np.pi * freq * t + phase) / number for number, (freq, phase) in enumerate(zip(rng.uniform(60, 4000, 6), rng.uniform(0, np.pi, 6)), 1))
+    envelope = 0.35 + 0.25 * np.sin(2 * np.pi * t / 20)
+    data = envelope[:, None] * partials[:, None] * np.array([1.0, 0.8]) / 3 + noise * rng.standard_normal((t.size, 2))
+    return data.astype(np.float32)
+
+
+def writeSignal(directory: str, name: str, duration: float, rate: int, audio_format: str, seed: int, noise: float = 0.02) -> str:
+    path = os.path.join(directory, f'{name}_{duration:g}s_{rate}.{audio_format}')
+    sf.write(path, makeSignal(duration, rate, seed, noise), rate)
+    return path
+
+
+def measure(func, repeat: int) -> dict:
+    func()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return {'median': statistics.median(times), 'min': min(times), 'repeat': repeat}
+
+
+def getLevels(path: str) -> (float, float):
+    data, _ = sf.read(path, dtype='float64')
+    return 20 * np.log10(np.sqrt(np.mean(np.square(data)))), 20 * np.log10(np.max(np.abs(data)))
+
+
+def checkCrossRate(directory: str, duration: float, rate: int, audio_format: str, tolerance: float) -> list:
+    # Partials without noise are where a spectrum carried over from another rate goes wrong, so a reference of another
+    # rate has to give the levels of the same reference written at the rate of the target
+    cross_rate = 44100 if rate != 44100 else 48000
+    target = writeSignal(directory, 'tonal_targ', duration, rate, audio_format, 0, noise=0)
+    levels = {}
+    for reference_rate in (rate, cross_rate):
+        levels[reference_rate] = getLevels(byReference(target, writeSignal(directory, 'tonal_ref', duration, reference_rate, audio_format, 1, noise=0)))
+
+    (rms, peak), (cross_rms, cross_peak) = levels[rate], levels[cross_rate]
+    print(f'Tonal {duration:g}s/{rate}/{audio_format}: reference at {rate} gives RMS {rms:.2f} peak {peak:.2f} dBFS, at {cross_rate} RMS {cross_rms:.2f} peak {cross_peak:.2f} dBFS', file=sys.stderr)
+    if abs(cross_rms - rms) > tolerance or abs(cross_peak - peak) > tolerance:
+        return [f'{duration:g}s/{rate}/{audio_format}: a {cross_rate} Hz reference changes the levels by more than {tolerance} dB']
+    return []
+
+
+def runFileBenchmarks(directory: str, args, results: dict) -> list:
+    failures = []
+    for duration in args.durations:
+        for rate in args.rates:
+            for audio_format in args.formats:
+                target = writeSignal(directory, 'targ', duration, rate, audio_format, 0)
+                reference = writeSignal(directory, 'ref', duration, rate, audio_format, 1)
+                case = f'{duration:g}s/{rate}/{audio_format}'
+
+                results[f'equalizeFile/{case}'] = measure(lambda: equalizeFile(target, equalization_params), args.repeat)
+                results[f'compressFile/{case}'] = measure(lambda: compressFile(target, **compression_params), args.repeat)
+                results[f'normalizeFile/{case}'] = measure(lambda: normalizeFile(target, **normalization_params), args.repeat)
+                results[f'byReference/{case}'] = measure(lambda: byReference(target, reference), args.repeat)
+                failures += checkCrossRate(directory, duration, rate, audio_format, args.level_tolerance)
+                print(f'Files {case} done', file=sys.stderr)
+    return failures
+
+
+def runUtilsBenchmarks(args, results: dict):
+    rate = 44100
+    for duration in args.durations:
+        data = makeSignal(duration, rate, 0).astype(np.float64)
+        mid, side = apu.convertToMidSide(data)
+        quantity, piece_size = apu.calculatePiecesParams(mid, rate)
+        pieces = apu.divideIntoPieces(mid, quantity, piece_size)
+        matching_fft = apu.averageFFT(pieces) / apu.averageFFT(apu.divideIntoPieces(side[:, 0], quantity, piece_size))
+        fir = apu.getFIR(pieces, apu.averageFFT(pieces))
+
+        results[f'getRMSes/{duration:g}s'] = measure(lambda: apu.getRMSes(pieces), args.repeat)
+        results[f'averageFFT/{duration:g}s'] = measure(lambda: apu.averageFFT(pieces), args.repeat)
+        results[f'smoothExponentially/{duration:g}s'] = measure(lambda: apu.smoothExponentially(matching_fft), args.repeat)
+        results[f'convolve/{duration:g}s'] = measure(lambda: apu.convolve(mid, fir, side, fir), args.repeat)
+        print(f'Utils {duration:g}s done', file=sys.stderr)
+
+
+def makeServiceConfig(directory: str, port: int) -> dict:
+    config = toml.load(os.path.join(repo_path, 'etc', 'processingModuleSOMconfig.toml'))
+    config['MAIN']['port'] = port
+    config['MAIN']['location'] = 'local'
+    config['MAIN']['workspace'] = os.path.join(directory, 'workspace')
+    config['CACHE']['directory'] = os.path.join(directory, 'cache')
+    return config
+
+
+async def roundTrip(session: asks.Session, port: int, body: dict) -> float:
+    # From /startProc until the task is Done, which happens once the /test/callback stub has answered 200
+    started = time.perf_counter()
+    resp = await session.post(f'http://127.0.0.1:{port}/startProc', data=json.dumps(body))
+    task_id = resp.text.strip()
+
+    while True:
+        resp = await session.get(f'http://127.0.0.1:{port}/getProcInfo/{task_id}')
+        status = resp.text.strip()
+        if status in ('Done', 'Error'):
+            break
+        await trio.sleep(0.01)
+
+    if status != 'Done':
+        raise RuntimeError(f'Task {task_id} ended with status {status}')
+    return time.perf_counter() - started
+
+
+async def runServiceBenchmarks(directory: str, args, results: dict):
+    from lib.core import Core
+
+    port = args.port
+    core = Core(makeServiceConfig(directory, port))
+    target = writeSignal(directory, 'service_targ', args.durations[0], 44100, 'wav', 0)
+    reference = writeSignal(directory, 'service_ref', args.durations[0], 44100, 'wav', 1)
+    callback = f'http://127.0.0.1:{port}/test/callback'
+
+    operations = {
+        'normalize': [{'type': 'normalization', 'params': normalization_params}],
+        'chain': [{'type': 'equalization', 'params': [{'frequencies': list(equalization_params), 'gain': 3}]}, {'type': 'compression', 'params': compression_params}, {'type': 'normalization', 'params': normalization_params}],
+        'reference': [{'type': 'reference', 'params': {'referenceTrack': reference}}]
+    }
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(core.run)
+        await trio.sleep(0.5)
+        session = asks.Session(connections=4)
+
+        for name, mastering_operations in operations.items():
+            body = {'targetTrack': target, 'callbackURL': callback, 'masteringOperations': mastering_operations}
+            await roundTrip(session, port, body)
+            times = [await roundTrip(session, port, body) for _ in range(args.repeat)]
+            results[f'startProc/{name}/{args.durations[0]:g}s'] = {'median': statistics.median(times), 'min': min(times), 'repeat': args.repeat}
+            print(f'Service {name} done', file=sys.stderr)
+
+        nursery.cancel_scope.cancel()
+
+
+def compareWithBaseline(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    print(f'{"benchmark":<40} {"baseline":>10} {"current":>10} {"ratio":>7}')
+    for name, result in results.items():
+        if name not in baseline:
+            print(f'{name:<40} {"-":>10} {result["median"]:>10.4f}')
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        mark = ' REGRESSION' if ratio > 1 + threshold else ''
+        print(f'{name:<40} {baseline[name]["median"]:>10.4f} {result["median"]:>10.4f} {ratio:>7.2f}{mark}')
+        if mark:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    args_parser = argparse.ArgumentParser(prog='masteringBenchmark.py', description='Times the mastering stages, their helpers and the /startProc round trip')
+    args_parser.add_argument('-d', '--durations', type=float, nargs='+', default=[30, 120], help='Signal lengths in seconds')
+    args_parser.add_argument('-r', '--rates', type=int, nargs='+', default=[44100, 48000])
+    args_parser.add_argument('-f', '--formats', nargs='+', default=['wav', 'flac'])
+    args_parser.add_argument('-n', '--repeat', type=int, default=3, help='Timed runs per benchmark, after one warm-up run')
+    args_parser.add_argument('-o', '--output', type=str, default=os.path.join(tempfile.gettempdir(), 'masteringBenchmark.json'), help='JSON file the results are written to, in the temporary directory by default')
+    args_parser.add_argument('-b', '--baseline', type=str, help='Results JSON of an earlier run to compare with')
+    args_parser.add_argument('-t', '--threshold', type=float, default=0.2, help='Slowdown of the median, relative to the baseline, reported as a regression')
+    args_parser.add_argument('-p', '--port', type=int, default=18000, help='Port of the service started for the round-trip benchmarks')
+    args_parser.add_argument('-l', '--level-tolerance', type=float, default=0.1, help='Largest level difference in dB between a tonal reference at the target rate and at another rate')
+    args_parser.add_argument('--skip-service', action='store_true', help='Do not run the /startProc round-trip benchmarks')
+    args = args_parser.parse_args()
+
+    logging.basicConfig(level='ERROR')
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        failures = runFileBenchmarks(directory, args, results)
+        runUtilsBenchmarks(args, results)
+        if not args.skip_service:
+            trio.run(runServiceBenchmarks, directory, args, results)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'args': vars(args),
+        'results': results
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(f'Results are written to {args.output}', file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)['results']
+        if regressions := compareWithBaseline(results, baseline, args.threshold):
+            failures.append(f'{len(regressions)} benchmarks are slower than the baseline by more than {args.threshold:.0%}')
+
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
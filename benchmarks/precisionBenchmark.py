@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+import statistics
+import tracemalloc
+import argparse
+import time
+import sys
+import os
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.mastering import equalize, compress, normalize, matchReference, analyzeReference
+
+
+def makeSignal(duration: float, rate: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * rate)) / rate
+    partials = sum(np.sin(2 * np.pi * freq * t) / number for number, freq in enumerate(rng.uniform(40, 6000, 8), 1))
+    envelope = 0.3 + 0.2 * np.sin(2 * np.pi * t / 7)
+    return envelope[:, None] * partials[:, None] * np.array([1.0, 0.7]) / 3 + 0.02 * rng.standard_normal((t.size, 2))
+
+
+def measure(func, repeat: int) -> (np.ndarray, float, int):
+    result = func()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+
+    # Peak of the memory allocated during one run, numpy reports its buffers to tracemalloc
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, statistics.median(times), peak
+
+
+def differenceLevel(result: np.ndarray, reference: np.ndarray) -> float:
+    # Peak of the difference signal in dBFS, -inf for identical outputs
+    peak = np.max(np.abs(result.astype(np.float64) - reference))
+    return 20 * np.log10(peak) if peak else -np.inf
+
+
+def main():
+    args_parser = argparse.ArgumentParser(prog='precisionBenchmark.py', description='Compares the float32 and float64 mastering stages')
+    args_parser.add_argument('-d', '--duration', type=float, default=60, help='Signal length in seconds')
+    args_parser.add_argument('-n', '--repeat', type=int, default=3, help='Timed runs per stage and precision')
+    args_parser.add_argument('-t', '--threshold', type=float, default=-80.0, help='Highest allowed peak of the float32 - float64 difference, in dBFS')
+    args = args_parser.parse_args()
+
+    rate = 44100
+    target = makeSignal(args.duration, rate, 0)
+    reference = makeSignal(args.duration, rate, 1) * 1.5
+
+    stages = {
+        'equalize': lambda data: equalize(data, rate, {100: 6, 1000: -4, 8000: 5})[0],
+        'compress': lambda data: compress(data, rate, threshold=-18.0, ratio=4.0)[0],
+        'normalize': lambda data: normalize(data, rate, dBFS=-14)[0],
+        'reference': lambda data: matchReference(data, rate, analyzeReference(reference.astype(data.dtype), rate))[0]
+    }
+
+    failed = []
+    print(f'{"stage":<10} {"float64 s":>10} {"float32 s":>10} {"float64 MB":>11} {"float32 MB":>11} {"difference dBFS":>16}')
+    for name, stage in stages.items():
+        result_64, time_64, memory_64 = measure(lambda: stage(target.astype(np.float64)), args.repeat)
+        result_32, time_32, memory_32 = measure(lambda: stage(target.astype(np.float32)), args.repeat)
+
+        if result_32.dtype != np.float32:
+            failed.append(f'{name} returned {result_32.dtype} for float32 input')
+        level = differenceLevel(result_32, result_64)
+        if level > args.threshold:
+            failed.append(f'{name} differs from float64 by {level:.1f} dBFS')
+        print(f'{name:<10} {time_64:>10.3f} {time_32:>10.3f} {memory_64 / 1024**2:>11.1f} {memory_32 / 1024**2:>11.1f} {level:>16.1f}')
+
+    if failed:
+        sys.exit('\n'.join(failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import logging
+import trio
+import uuid
+
+
+class SharedResult:
+    def __init__(self):
+        self.done = trio.Event()
+        self.value = None
+        self.error = None
+
+
+class Batch:
+    def __init__(self, logger=None):
+        self.id = uuid.uuid4().hex
+        self.logger = logger if logger else logging.getLogger(f'BATCH_{self.id}')
+        self.tasks = []
+        self.shared = dict()
+        self.users = dict()
+
+
+    def addTask(self, task, shared_keys: list):
+        self.tasks.append(task)
+        for key in shared_keys:
+            self.users[key] = self.users.get(key, 0) + 1
+
+
+    def release(self, key):
+        # Large shared values (decoded audio) are dropped as soon as the last item that needs them has them
+        self.users[key] = self.users.get(key, 1) - 1
+        if self.users[key] <= 0:
+            self.shared.pop(key, None)
+
+
+    async def share(self, key, compute):
+        # The first item asking for a key computes it, the other items of the batch wait and reuse the result
+        if key not in self.shared:
+            result = self.shared[key] = SharedResult()
+            self.logger.debug(f'Computing shared {key}')
+            try:
+                result.value = await compute()
+            except Exception as e:
+                result.error = e
+            finally:
+                result.done.set()
+
+        result = self.shared[key]
+        await result.done.wait()
+
+        if result.error is not None:
+            raise result.error
+        if result.value is None:
+            raise RuntimeError(f'Shared {key} was not computed')
+        return result.value
+
+
+    def finished(self) -> bool:
+        return all(task.status in ('Done', 'Error') for task in self.tasks)
+
+
+    def info(self) -> dict:
+        return summarizeBatch(self.id, [(task.id, task.subtasks['download']['target'], task.status, task.comment) for task in self.tasks])
+
+
+def summarizeBatch(batch_id: str, items: list) -> dict:
+    # items are (task_id, target, status, comment) rows, from live tasks or from the task store
+    statuses = [status for _, _, status, _ in items]
+
+    if all(status == 'Done' for status in statuses):
+        status = 'Done'
+    elif all(status in ('Done', 'Error') for status in statuses):
+        status = 'Error'
+    elif all(status == 'Created' for status in statuses):
+        status = 'Created'
+    else:
+        status = 'Processing'
+
+    return {
+        'id': batch_id,
+        'status': status,
+        'completed': sum(status in ('Done', 'Error') for status in statuses),
+        'total': len(statuses),
+        'items': [{'id': task_id, 'target': target, 'status': status, 'comment': comment} for task_id, target, status, comment in items]
+    }
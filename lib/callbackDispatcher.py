@@ -0,0 +1,287 @@
+import urllib.parse
+import logging
+import random
+import json
+import time
+import trio
+import h11
+
+
+class CallbackError(Exception):
+    pass
+
+
+class HostPool:
+    def __init__(self, connections: int):
+        self.limiter = trio.CapacityLimiter(connections)
+        self.idle = []
+
+
+class PendingBatch:
+    def __init__(self):
+        self.entries = []
+        self.full = trio.Event()
+        self.done = trio.Event()
+        self.result = None
+
+
+class CallbackDispatcher:
+    # Shared by all tasks. Keep-alive connections are pooled per callback origin, and every callback is written to
+    # the outbox of the task store before its first attempt. It leaves the outbox once a receiver has answered,
+    # or once it is older than outbox_max_age
+    def __init__(self, config: dict, store, logger=logging.getLogger('CALLBACKS')):
+        self.logger = logger
+        self.store = store
+        self.chunk_size = config['DELIVERY']['chunk_size']
+        self.retries = config['DELIVERY']['retries']
+        self.timeout = config['DELIVERY']['timeout']
+        self.backoff = config['DELIVERY']['backoff']
+        self.connections_per_host = config['DELIVERY']['connections_per_host']
+        self.idle_timeout = config['DELIVERY']['idle_timeout']
+        self.outbox_interval = config['DELIVERY']['outbox_interval']
+        self.outbox_max_age = config['DELIVERY']['outbox_max_age']
+        self.coalesce = config['DELIVERY']['coalesce']
+        self.coalesce_window = config['DELIVERY']['coalesce_window']
+        self.coalesce_max = config['DELIVERY']['coalesce_max']
+        self.in_flight = trio.CapacityLimiter(config['DELIVERY']['max_in_flight'])
+        self.pools = dict()
+        self.batches = dict()
+        self.dropped = 0
+
+
+    def idleConnections(self) -> int:
+        return sum(len(pool.idle) for pool in self.pools.values())
+
+
+    def parseURL(self, url: str) -> (tuple, str, str):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise CallbackError(f'Unsupported callback URL {url}')
+
+        origin = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        return origin, parts.netloc, target
+
+
+    async def acquire(self, origin: tuple, pool: HostPool) -> (trio.abc.Stream, h11.Connection, bool):
+        while pool.idle:
+            stream, connection, idle_since = pool.idle.pop()
+            if trio.current_time() - idle_since < self.idle_timeout:
+                return stream, connection, True
+            await trio.aclose_forcefully(stream)
+
+        scheme, host, port = origin
+        with trio.fail_after(self.timeout):
+            if scheme == 'https':
+                stream = await trio.open_ssl_over_tcp_stream(host, port)
+            else:
+                stream = await trio.open_tcp_stream(host, port)
+        return stream, h11.Connection(our_role=h11.CLIENT), False
+
+
+    async def send(self, stream: trio.abc.Stream, data: bytes):
+        with trio.fail_after(self.timeout):
+            await stream.send_all(data)
+
+
+    async def exchange(self, stream: trio.abc.Stream, connection: h11.Connection, target: str, headers: list, chunks) -> int:
+        await self.send(stream, connection.send(h11.Request(method='POST', target=target, headers=headers)))
+        async for chunk in chunks():
+            await self.send(stream, connection.send(h11.Data(data=chunk)))
+        await self.send(stream, connection.send(h11.EndOfMessage()))
+
+        status_code = None
+        while True:
+            event = connection.next_event()
+            if event is h11.NEED_DATA:
+                with trio.fail_after(self.timeout):
+                    connection.receive_data(await stream.receive_some(65536))
+            elif isinstance(event, h11.Response):
+                status_code = event.status_code
+            elif isinstance(event, h11.EndOfMessage):
+                return status_code
+            elif isinstance(event, h11.ConnectionClosed):
+                raise trio.BrokenResourceError('Connection closed before the response')
+
+
+    async def post(self, url: str, chunks, size: int, content_type: str) -> int:
+        origin, host, target = self.parseURL(url)
+        pool = self.pools.setdefault(origin, HostPool(self.connections_per_host))
+        headers = [('Host', host), ('Content-Type', content_type), ('Content-Length', str(size))]
+
+        async with self.in_flight, pool.limiter:
+            while True:
+                stream, connection, reused = await self.acquire(origin, pool)
+                try:
+                    status_code = await self.exchange(stream, connection, target, headers, chunks)
+                except Exception:
+                    await trio.aclose_forcefully(stream)
+                    # The receiver may have closed a pooled connection while it was idle, a fresh one is not counted as an attempt
+                    if reused:
+                        continue
+                    raise
+
+                if connection.our_state is h11.DONE and connection.their_state is h11.DONE:
+                    connection.start_next_cycle()
+                    pool.idle.append((stream, connection, trio.current_time()))
+                else:
+                    await trio.aclose_forcefully(stream)
+                return status_code
+
+
+    def jitter(self, attempt: int) -> float:
+        # Full jitter, so callbacks that failed together during an outage do not all come back at the same moment
+        return random.uniform(0, self.backoff * 2 ** (attempt - 1))
+
+
+    async def attempt(self, url: str, body: tuple, attempts: int) -> (str, str):
+        # Outcome is 'sent', 'failed' for errors a retry can not fix, or 'retry'
+        for attempt in range(1, attempts + 1):
+            try:
+                status_code = await self.post(url, *body)
+            except CallbackError as e:
+                return 'failed', str(e)
+            except Exception as e:
+                error = f'{type(e).__name__} {str(e)}'
+            else:
+                if status_code == 200:
+                    return 'sent', 'Success'
+                if status_code is not None and status_code < 500 and status_code not in (408, 429):
+                    return 'failed', 'Unsuccessfull callback HTTP status code'
+                error = f'HTTP status code {status_code}'
+
+            self.logger.warning(f'Callback to {url} failed: "{error}"')
+            if attempt < attempts:
+                await trio.sleep(self.jitter(attempt))
+        return 'retry', error
+
+
+    async def makeBody(self, entries: list) -> tuple:
+        # Coalesced callbacks are sent as one JSON array of {"id": <task ID>, "result": <text>} objects
+        if entries[0]['coalesce']:
+            data = json.dumps([{'id': entry['task_id'], 'result': entry['text']} for entry in entries]).encode('utf-8')
+            content_type = 'application/json'
+        elif entries[0]['path']:
+            path = entries[0]['path']
+            try:
+                size = (await trio.Path(path).stat()).st_size
+            except OSError as e:
+                raise CallbackError(f'Result file is not available: {str(e)}')
+
+            async def chunks():
+                async with await trio.open_file(path, 'rb') as file:
+                    while chunk := await file.read(self.chunk_size):
+                        yield chunk
+
+            return chunks, size, 'application/octet-stream'
+        else:
+            data = entries[0]['text'].encode('utf-8')
+            content_type = 'text/plain; charset=utf-8'
+
+        async def chunks():
+            yield data
+
+        return chunks, len(data), content_type
+
+
+    async def settle(self, entries: list, outcome: str, comment: str, size: int) -> (bool, str, int):
+        if outcome == 'retry':
+            schedule = []
+            for entry in entries:
+                attempts = entry['attempts'] + 1
+                delay = min(self.outbox_interval * 2 ** (attempts - 1), self.outbox_max_age) * random.uniform(0.5, 1.5)
+                schedule.append((attempts, time.time() + delay, entry['id']))
+            await self.store.rescheduleCallbacks(schedule)
+        else:
+            await self.store.deleteCallbacks([entry['id'] for entry in entries])
+
+        if outcome == 'sent':
+            return True, 'Success', size
+        if outcome == 'retry':
+            return True, f'Callback is queued for redelivery after: {comment}', 0
+        return False, comment, 0
+
+
+    async def sendEntries(self, url: str, entries: list, attempts: int) -> (bool, str, int):
+        try:
+            body = await self.makeBody(entries)
+        except CallbackError as e:
+            return await self.settle(entries, 'failed', str(e), 0)
+
+        outcome, comment = await self.attempt(url, body, attempts)
+        return await self.settle(entries, outcome, comment, body[1])
+
+
+    async def coalesceEntry(self, url: str, entry: dict) -> (bool, str, int):
+        # The first callback to a URL waits coalesce_window seconds, or until coalesce_max callbacks joined it, and sends them all
+        batch = self.batches.get(url)
+        leader = batch is None
+        if leader:
+            batch = self.batches[url] = PendingBatch()
+
+        batch.entries.append(entry)
+        if len(batch.entries) >= self.coalesce_max:
+            self.batches.pop(url, None)
+            batch.full.set()
+
+        if leader:
+            try:
+                with trio.move_on_after(self.coalesce_window):
+                    await batch.full.wait()
+                if self.batches.get(url) is batch:
+                    del self.batches[url]
+                batch.result = await self.sendEntries(url, batch.entries, self.retries + 1)
+            finally:
+                # Followers wait for the leader, they must be released even when it failed or was cancelled
+                if self.batches.get(url) is batch:
+                    del self.batches[url]
+                if batch.result is None:
+                    batch.result = (False, 'Coalesced callback was not sent', 0)
+                batch.done.set()
+        else:
+            await batch.done.wait()
+
+        ok, comment, sent = batch.result
+        return ok, comment, len(entry['text'].encode('utf-8')) if sent else 0
+
+
+    async def deliver(self, task_id: str, url: str, path: str = None, text: str = None) -> (bool, str, int):
+        # Either the file at path is sent as the body, or the text. A callback still failing after the inline retries
+        # is left in the outbox for redelivery and the task is not failed because of it
+        coalesce = self.coalesce and text is not None
+        callback_id = await self.store.addCallback(task_id, url, path, text, coalesce)
+        entry = {'id': callback_id, 'task_id': task_id, 'url': url, 'path': path, 'text': text, 'coalesce': coalesce, 'attempts': 0}
+
+        if coalesce:
+            return await self.coalesceEntry(url, entry)
+        return await self.sendEntries(url, [entry], self.retries + 1)
+
+
+    async def redeliver(self, url: str, entries: list):
+        ok, comment, _ = await self.sendEntries(url, entries, 1)
+        if comment == 'Success':
+            self.logger.info(f'Redelivered {len(entries)} callbacks to {url}')
+        elif not ok:
+            self.logger.error(f'Dropped {len(entries)} callbacks to {url}: {comment}')
+            self.dropped += len(entries)
+
+
+    async def run(self):
+        if reset := await self.store.resetCallbacks():
+            self.logger.info(f'{reset} callbacks from before the restart are due for redelivery')
+
+        async with trio.open_nursery() as nursery:
+            while True:
+                if expired := await self.store.deleteExpiredCallbacks(self.outbox_max_age):
+                    self.logger.error(f'Dropped {expired} callbacks that could not be delivered in {self.outbox_max_age} seconds')
+                    self.dropped += expired
+
+                groups = dict()
+                for entry in await self.store.claimDueCallbacks():
+                    key = (entry['url'], entry['coalesce'], entry['id'] if not entry['coalesce'] else None)
+                    groups.setdefault(key, []).append(entry)
+                for (url, *_), entries in groups.items():
+                    for start in range(0, len(entries), self.coalesce_max):
+                        nursery.start_soon(self.redeliver, url, entries[start:start + self.coalesce_max])
+
+                await trio.sleep(self.outbox_interval)
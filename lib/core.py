@@ -1,32 +1,35 @@
 import logging
+import urllib.parse
 import trio
 import json
 import sys
 
 from .http import HttpServer
 from .taskManager import TaskManager
-from .task import Task
-
-
-@HttpServer.route('POST', '/startProc')
-async def startTask(server, stream, path_args: dict = {}, body: str = ''):
-    server.logger.debug('Inside the "startTask" function')
-    try:
-        body_dict = json.loads(body)
-    except json.JSONDecodeError as e:
-        server.logger.error(f'JSON load error: {str(e)}. Send 400 Bad Request')
-        await stream.send_all(f'HTTP/1.0 400 Bad Request\r\n\r\nJSON load error\n'.encode('utf-8'))
-        return
-    
+from .task import Task, priority_range
+from .batch import Batch
+from .mastering import verifyFormat, verifySampleRate
+from .dspExecutor import DSPExecutor
+from .downloader import Downloader
+from .callbackDispatcher import CallbackDispatcher
+from .referenceCache import ReferenceCache
+from .taskStore import TaskStore
+from .workspaceManager import WorkspaceManager
+from .metrics import Metrics
+from .eventBroker import EventBroker
+
+
+def parseTaskRequest(body_dict: dict) -> (dict, int, str):
     subtasks = dict()
 
+    if not isinstance(body_dict, dict):
+        raise ValueError('JSON is incorrect')
+
     subtasks['download'] = {'target': body_dict.get('targetTrack')}
     callback = body_dict.get('callbackURL')
 
     if not subtasks['download']['target'] or not callback or 'masteringOperations' not in body_dict.keys():
-        server.logger.error(f'JSON is incorrect: {str(e)}. Send 400 Bad Request')
-        await stream.send_all(b'HTTP/1.0 400 Bad Request\r\n\r\nJSON is incorrect\n')
-        return
+        raise ValueError('JSON is incorrect')
 
     find = lambda opers, key: next((item for item in opers if item['type'] == key), None)
 
@@ -43,51 +46,209 @@ async def startTask(server, stream, path_args: dict = {}, body: str = ''):
 
             if normalization := find(body_dict['masteringOperations'], 'normalization'):
                 subtasks['normalize'] = normalization['params']
+
+        if output_format := body_dict.get('outputFormat'):
+            verifyFormat(output_format)
+
+        if output_rate := body_dict.get('outputSampleRate'):
+            verifySampleRate(output_rate)
     except Exception as e:
-        server.logger.error(f'Bad masteringOperations structure: {str(e)}. Send 400 Bad Request')
-        await stream.send_all(f'HTTP/1.0 400 Bad Request\r\n\r\nBad masteringOperations structure\n'.encode('utf-8'))
+        raise ValueError('Bad masteringOperations structure') from e
+
+    priority = body_dict.get('priority')
+    if priority is not None and (type(priority) is not int or priority not in priority_range):
+        raise ValueError(f'priority must be an integer from {priority_range.start} to {priority_range.stop - 1}')
+
+    subtasks['final'] = {'callback': callback, 'format': output_format, 'rate': output_rate}
+
+    client = body_dict.get('clientID') or urllib.parse.urlsplit(callback).netloc
+
+    return subtasks, priority, client
+
+
+@HttpServer.route('POST', '/startProc')
+async def startTask(server, stream, path_args: dict = {}, body: str = ''):
+    server.logger.debug('Inside the "startTask" function')
+    if server.task_manager.new_tasks_queue.full():
+        server.logger.warning('Pending tasks queue is full. Send 503 Service Unavailable')
+        await stream.respond(503, 'Too many pending tasks\n', {'Retry-After': server.task_manager.retry_after})
         return
 
-    subtasks['final'] = {'callback': callback}
+    if server.task_manager.workspace.full():
+        server.logger.warning('Workspace disk quota is exhausted. Send 503 Service Unavailable')
+        await stream.respond(503, 'Workspace disk quota is exhausted\n', {'Retry-After': server.task_manager.retry_after})
+        return
 
-    task = Task(subtasks, server.config)
-    await server.task_manager.new_tasks_queue.put(task)
+    try:
+        body_dict = json.loads(body)
+    except json.JSONDecodeError as e:
+        server.logger.error(f'JSON load error: {str(e)}. Send 400 Bad Request')
+        await stream.respond(400, 'JSON load error\n')
+        return
 
-    await stream.send_all(f'HTTP/1.0 200 OK\r\n\r\n{task.id}\n'.encode('utf-8'))
+    try:
+        subtasks, priority, client = parseTaskRequest(body_dict)
+    except ValueError as e:
+        server.logger.error(f'{str(e)}. Send 400 Bad Request', exc_info=e.__cause__)
+        await stream.respond(400, f'{str(e)}\n')
+        return
+
+    task = Task(subtasks, server.config, priority=priority, client=client)
+    await server.task_manager.addTasks([task])
+
+    await stream.respond(200, f'{task.id}\n')
     server.logger.debug(f'End of the "startTask" function')
 
 
+@HttpServer.route('POST', '/startBatch')
+async def startBatch(server, stream, path_args: dict = {}, body: str = ''):
+    server.logger.debug('Inside the "startBatch" function')
+    try:
+        body_dict = json.loads(body)
+    except json.JSONDecodeError as e:
+        server.logger.error(f'JSON load error: {str(e)}. Send 400 Bad Request')
+        await stream.respond(400, 'JSON load error\n')
+        return
+
+    items = body_dict.get('items') if isinstance(body_dict, dict) else None
+    if not items or not isinstance(items, list):
+        server.logger.error(f'Batch without items. Send 400 Bad Request')
+        await stream.respond(400, 'JSON is incorrect\n')
+        return
+
+    if not server.task_manager.new_tasks_queue.hasRoom(len(items)):
+        server.logger.warning('Pending tasks queue has no room for the batch. Send 503 Service Unavailable')
+        await stream.respond(503, 'Too many pending tasks\n', {'Retry-After': server.task_manager.retry_after})
+        return
+
+    if server.task_manager.workspace.full():
+        server.logger.warning('Workspace disk quota is exhausted. Send 503 Service Unavailable')
+        await stream.respond(503, 'Workspace disk quota is exhausted\n', {'Retry-After': server.task_manager.retry_after})
+        return
+
+    # Item fields override the batch-level defaults (callbackURL, masteringOperations, outputFormat, ...)
+    defaults = {key: value for key, value in body_dict.items() if key != 'items'}
+    try:
+        parsed_items = [parseTaskRequest({**defaults, **item}) for item in items]
+    except (ValueError, TypeError) as e:
+        server.logger.error(f'Bad batch item: {str(e)}. Send 400 Bad Request', exc_info=e.__cause__)
+        await stream.respond(400, f'{str(e)}\n')
+        return
+
+    batch = Batch()
+    for subtasks, priority, client in parsed_items:
+        task = Task(subtasks, server.config, priority=priority, client=client, batch=batch)
+        batch.addTask(task, [task.sharedAudioKey()])
+
+    server.task_manager.addBatch(batch)
+    await server.task_manager.addTasks(batch.tasks)
+
+    await stream.respond(200, json.dumps({'batchID': batch.id, 'tasks': [task.id for task in batch.tasks]}), {'Content-Type': 'application/json'})
+    server.logger.debug(f'End of the "startBatch" function')
+
+
+@HttpServer.route('GET', '/getBatchInfo/{id}')
+async def getBatchInfo(server, stream, path_args: dict = {}, body: str = ''):
+    server.logger.debug('Inside the "getBatchInfo" function')
+    info = await server.task_manager.getBatchInfo(path_args['id'])
+
+    if info is None:
+        server.logger.error(f'Batch Not Found. Send 404 Not Found')
+        await stream.respond(404, 'Batch Not Found\n')
+    else:
+        await stream.respond(200, json.dumps(info), {'Content-Type': 'application/json'})
+
+
 @HttpServer.route('GET', '/getProcInfo/{id}')
 async def getTaskInfo(server, stream, path_args: dict = {}, body: str = ''):
     server.logger.debug('Inside the "getTaskInfo" function')
-    status = server.task_manager.get_task_status(path_args['id'])
+    status = await server.task_manager.getTaskStatus(path_args['id'])
 
     if status is None:
-        server.logger.error(f'Task Not Found. Send 200 OK')
-        response = b'HTTP/1.0 404 Not Found\r\n\r\nTask Not Found\n'
+        server.logger.error(f'Task Not Found. Send 404 Not Found')
+        await stream.respond(404, 'Task Not Found\n')
     else:
-        response = f'HTTP/1.0 200 OK\r\n\r\n{status}\n'.encode('utf-8')
-    
-    await stream.send_all(response)
+        await stream.respond(200, f'{status}\n')
     server.logger.debug(f'End of the "getTaskInfo" function')
 
 
+@HttpServer.route('GET', '/events')
+async def streamEvents(server, stream, path_args: dict = {}, body: str = ''):
+    server.logger.debug('Inside the "streamEvents" function')
+    task_ids = {task_id for value in stream.request.query.get('ids', []) for task_id in value.split(',') if task_id}
+    if not task_ids:
+        server.logger.error('Events request without task IDs. Send 400 Bad Request')
+        await stream.respond(400, 'Task IDs are a mandatory parameter\n')
+        return
+
+    events = server.task_manager.events
+    subscription = events.subscribe(task_ids)
+    try:
+        # Current statuses are taken right after subscribing, every event received later is newer than them
+        snapshot = b''
+        pending = set()
+        for task_id in sorted(task_ids):
+            status = await server.task_manager.getTaskStatus(task_id)
+            snapshot += events.formatEvent('status', {'id': task_id, 'status': status or 'Not Found'})
+            if status not in (None, 'Done', 'Error'):
+                pending.add(task_id)
+
+        await stream.respondStream(200, {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await stream.send_all(snapshot)
+
+        # The stream ends once every subscribed task has finished
+        while pending:
+            with trio.move_on_after(events.keep_alive) as keep_alive:
+                task_id, event, data, message = await subscription.receive_channel.receive()
+            if keep_alive.cancelled_caught:
+                await stream.send_all(b': keep-alive\n\n')
+                continue
+
+            await stream.send_all(message)
+            if event == 'status' and data['status'] in ('Done', 'Error'):
+                pending.discard(task_id)
+    except trio.EndOfChannel:
+        server.logger.info('Events stream of a slow subscriber is closed')
+    finally:
+        events.unsubscribe(subscription)
+
+
+@HttpServer.route('GET', '/metrics')
+async def getMetrics(server, stream, path_args: dict = {}, body: str = ''):
+    await stream.respond(200, server.task_manager.metrics.render(), {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
 @HttpServer.route('POST', '/test/callback')
 async def testCallback(server, stream, path_args: dict = {}, body: str = ''):
     server.logger.debug('Inside the "testCallback" function')
     server.logger.info(f'Callback received: {body}')
-    await stream.send_all(b'HTTP/1.0 200 OK\r\n\r\n')
+    await stream.respond(200)
 
 
 class Core:
     def __init__(self, config):
-        self.task_manager = TaskManager()
+        self.dsp_executor = DSPExecutor(config)
+        self.downloader = Downloader(config)
+        self.reference_cache = ReferenceCache(config)
+        self.task_store = TaskStore(config)
+        self.callbacks = CallbackDispatcher(config, self.task_store)
+        self.workspace = WorkspaceManager(config)
+        self.events = EventBroker(config)
+        self.metrics = Metrics()
+        self.task_manager = TaskManager(config, self.dsp_executor, self.downloader, self.callbacks, self.reference_cache, self.task_store, self.workspace, self.events, self.metrics)
         self.server = HttpServer(self.task_manager, config)
 
 
     async def run(self):
-        async with trio.open_nursery() as nursery:
-            nursery.start_soon(self.task_manager.processTasks)
-            nursery.start_soon(self.server.run)
+        try:
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(self.task_manager.processTasks)
+                nursery.start_soon(self.task_manager.expireTasks)
+                nursery.start_soon(self.task_manager.sweepWorkspaces)
+                nursery.start_soon(self.callbacks.run)
+                nursery.start_soon(self.server.run)
+        finally:
+            self.dsp_executor.shutdown()
+            self.task_store.close()
             
 
@@ -0,0 +1,133 @@
+import contextlib
+import logging
+import trio
+import asks
+
+
+class DownloadError(Exception):
+    pass
+
+
+class TransientStatusError(Exception):
+    # A server error or rate limit, retried like a broken connection
+    pass
+
+
+def parseContentRange(value: str) -> (int, int):
+    # 'bytes <start>-<end>/<total>' of a 206 or 'bytes */<total>' of a 416, None for a part that is missing or unknown
+    try:
+        unit, _, spec = value.strip().partition(' ')
+        span, _, total = spec.partition('/')
+        start = int(span.partition('-')[0]) if unit == 'bytes' and span != '*' else None
+        return start, int(total) if total.isdigit() else None
+    except (AttributeError, ValueError):
+        return None, None
+
+
+class Downloader:
+    def __init__(self, config: dict, logger=logging.getLogger('DOWNLOADER')):
+        self.logger = logger
+        self.session = asks.Session(connections=config['DOWNLOAD']['connections'])
+        self.chunk_size = config['DOWNLOAD']['chunk_size']
+        self.max_size = config['DOWNLOAD']['max_size_mb'] * 1024 * 1024
+        self.retries = config['DOWNLOAD']['retries']
+        self.timeout = config['DOWNLOAD']['timeout']
+
+
+    @contextlib.asynccontextmanager
+    async def openBody(self, resp):
+        # asks streams only responses that have a body, an empty one (e.g. of an error status) arrives as bytes
+        if isinstance(resp.body, (bytes, bytearray)):
+            async def chunks():
+                if resp.body:
+                    yield bytes(resp.body)
+            yield chunks()
+        else:
+            async with resp.body:
+                yield resp.body(timeout=self.timeout)
+
+
+    async def restart(self, file):
+        await file.seek(0)
+        await file.truncate()
+
+
+    async def receiveInto(self, url: str, file, received: int) -> int:
+        headers = {'Range': f'bytes={received}-'} if received else {}
+        resp = await self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+
+        async with self.openBody(resp) as chunks:
+            if received and resp.status_code == 416:
+                # Nothing is left after the requested offset: the file is complete only if the server reports the same size
+                _, total = parseContentRange(resp.headers.get('content-range'))
+                if total == received:
+                    return received
+                await self.restart(file)
+                raise TransientStatusError(f'Range from {received} bytes is not satisfiable for a file of {total} bytes, restarting')
+            elif received and resp.status_code == 200:
+                self.logger.debug(f'Server ignored the Range header, restarting download of {url}')
+                await self.restart(file)
+                received = 0
+            elif resp.status_code == 206:
+                # The part is written right after the received bytes, so it must start exactly there
+                start, _ = parseContentRange(resp.headers.get('content-range'))
+                if start != received:
+                    await self.restart(file)
+                    raise TransientStatusError(f'Content-Range starts at {start} instead of {received} bytes, restarting')
+            elif resp.status_code >= 500 or resp.status_code == 429:
+                raise TransientStatusError(f'HTTP status code {resp.status_code}')
+            elif resp.status_code not in (200, 206):
+                raise DownloadError(f'Unexpected HTTP status code {resp.status_code}')
+
+            if received + int(resp.headers.get('content-length', 0)) > self.max_size:
+                raise DownloadError(f'File is larger than {self.max_size} bytes')
+
+            buffer = bytearray()
+            try:
+                async for chunk in chunks:
+                    buffer += chunk
+                    if received + len(buffer) > self.max_size:
+                        raise DownloadError(f'File is larger than {self.max_size} bytes')
+                    if len(buffer) >= self.chunk_size:
+                        await file.write(buffer)
+                        received += len(buffer)
+                        buffer.clear()
+            finally:
+                # Whatever arrived before a broken connection is kept, so the next attempt resumes from it
+                await file.write(buffer)
+                received += len(buffer)
+
+        return received
+
+
+    async def probe(self, url: str) -> tuple:
+        # Validators of a HEAD request, they identify the content without downloading it. Without an ETag or
+        # Last-Modified header the response says nothing about the content and None is returned
+        try:
+            resp = await self.session.head(url, timeout=self.timeout)
+        except Exception as e:
+            self.logger.debug(f'HEAD request to {url} failed: "{type(e).__name__} {str(e)}"')
+            return None
+
+        etag, last_modified = resp.headers.get('etag'), resp.headers.get('last-modified')
+        if resp.status_code != 200 or not (etag or last_modified):
+            return None
+        return url, etag, last_modified, resp.headers.get('content-length')
+
+
+    async def download(self, url: str, dst: str) -> (bool, str, int):
+        attempt = 0
+        async with await trio.open_file(dst, 'wb') as file:
+            while True:
+                received = await file.tell()
+                try:
+                    received = await self.receiveInto(url, file, received)
+                    return True, dst, received
+                except DownloadError as e:
+                    return False, str(e), received
+                except Exception as e:
+                    attempt += 1
+                    if attempt > self.retries:
+                        return False, f'Download failed after {attempt} attempts: {str(e)}', received
+                    self.logger.warning(f'Download of {url} interrupted at {await file.tell()} bytes: "{type(e).__name__} {str(e)}". Resuming')
+                    await trio.sleep(2 ** (attempt - 1))
@@ -0,0 +1,223 @@
+import concurrent.futures
+import multiprocessing
+import logging
+import trio
+import time
+import os
+
+import numpy as np
+
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory, resource_tracker
+
+
+class SharedArray:
+    def __init__(self, name: str, shape: tuple, dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+class MappedArray:
+    def __init__(self, path: str, offset: int, shape: tuple, dtype: str):
+        self.path = path
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+def describeMapping(array: np.ndarray) -> MappedArray:
+    # An array that is a whole read-only file mapping, as audioIO.mapAudio returns, is mapped again by the worker
+    # instead of copied into shared memory
+    base = array.base
+    if isinstance(base, np.memmap) and base.mode == 'r' and array.shape == base.shape and array.dtype == base.dtype and array.ctypes.data == base.ctypes.data:
+        return MappedArray(base.filename, base.offset, array.shape, array.dtype.str)
+    return None
+
+
+def mapArray(mapped: MappedArray) -> np.ndarray:
+    return np.asarray(np.memmap(mapped.path, np.dtype(mapped.dtype), 'r', mapped.offset, mapped.shape))
+
+
+def shareArray(array: np.ndarray) -> (shared_memory.SharedMemory, SharedArray):
+    segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+    view[...] = array
+    del view
+    return segment, SharedArray(segment.name, array.shape, array.dtype.str)
+
+
+def attachArray(shared: SharedArray) -> (shared_memory.SharedMemory, np.ndarray):
+    segment = shared_memory.SharedMemory(name=shared.name)
+    return segment, np.ndarray(shared.shape, dtype=np.dtype(shared.dtype), buffer=segment.buf)
+
+
+def collectArray(shared: SharedArray) -> np.ndarray:
+    segment, view = attachArray(shared)
+    array = np.array(view)
+    del view
+    segment.close()
+    segment.unlink()
+    return array
+
+
+def releaseFuture(future: concurrent.futures.Future):
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    result, _ = future.result()
+    for item in (result if isinstance(result, tuple) else (result, )):
+        if isinstance(item, SharedArray):
+            segment = shared_memory.SharedMemory(name=item.name)
+            segment.close()
+            segment.unlink()
+
+
+def runShared(func, args: tuple, kwargs: dict):
+    # Runs inside a pool worker: arrays come in through shared memory segments or file mappings and go out through shared memory segments
+    segments = []
+    call_args = []
+    for arg in args:
+        if isinstance(arg, SharedArray):
+            segment, arg = attachArray(arg)
+            segments.append(segment)
+        elif isinstance(arg, MappedArray):
+            arg = mapArray(arg)
+        call_args.append(arg)
+
+    started = time.process_time()
+    result = func(*call_args, **kwargs)
+    cpu_time = time.process_time() - started
+    is_tuple = isinstance(result, tuple)
+    items = result if is_tuple else (result, )
+
+    shared_items = []
+    for item in items:
+        if isinstance(item, np.ndarray):
+            segment, item = shareArray(item)
+            # The parent process unlinks the segment after copying the result out
+            resource_tracker.unregister(segment._name, 'shared_memory')
+            segment.close()
+        shared_items.append(item)
+
+    del call_args, result, items
+    for segment in segments:
+        segment.close()
+
+    return (tuple(shared_items) if is_tuple else shared_items[0]), cpu_time
+
+
+def runThreadTimed(func, args: tuple, kwargs: dict):
+    started = time.thread_time()
+    result = func(*args, **kwargs)
+    return result, time.thread_time() - started
+
+
+async def waitFuture(future: concurrent.futures.Future):
+    token = trio.lowlevel.current_trio_token()
+    done = trio.Event()
+
+    def notify(_):
+        # A job can outlive the trio run when the service is stopped while it is running
+        try:
+            token.run_sync_soon(done.set)
+        except trio.RunFinishedError:
+            pass
+
+    future.add_done_callback(notify)
+    await done.wait()
+    return future.result()
+
+
+class DSPExecutor:
+    def __init__(self, config: dict, logger=logging.getLogger('DSP_EXECUTOR')):
+        self.logger = logger
+        self.backend = config['WORKERS']['backend']
+        self.workers = config['WORKERS']['processes'] or os.cpu_count()
+        self.pool = None
+        self.active = 0
+        self.busy_seconds = 0.0
+
+        if self.backend == 'process':
+            self.max_tasks_per_child = config['WORKERS']['max_tasks_per_child'] or None
+            self.pool = self.createPool()
+            self.logger.info(f'Process pool with {self.workers} workers, {self.max_tasks_per_child} tasks per child')
+        elif self.backend == 'thread':
+            self.logger.info('DSP runs in trio worker threads')
+        else:
+            raise ValueError(f'Unknown workers backend "{self.backend}"')
+
+
+    def createPool(self) -> concurrent.futures.ProcessPoolExecutor:
+        return concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'), max_tasks_per_child=self.max_tasks_per_child)
+
+
+    def replacePool(self, broken: concurrent.futures.ProcessPoolExecutor):
+        # Every job of a pool whose worker died fails with BrokenProcessPool, only the first one to see it replaces the pool
+        if self.pool is broken:
+            self.logger.error('A DSP worker process died, the process pool is recreated')
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.pool = self.createPool()
+
+
+    async def run(self, func, *args, **kwargs):
+        result, _ = await self.runTimed(func, *args, **kwargs)
+        return result
+
+
+    async def runTimed(self, func, *args, **kwargs) -> (object, float):
+        # Returns the result and the CPU time the job used in its worker
+        started = trio.current_time()
+        self.active += 1
+        try:
+            return await self.runJob(func, args, kwargs)
+        finally:
+            self.active -= 1
+            self.busy_seconds += trio.current_time() - started
+
+
+    async def runJob(self, func, args: tuple, kwargs: dict) -> (object, float):
+        if self.pool is None:
+            return await trio.to_thread.run_sync(runThreadTimed, func, args, kwargs)
+
+        segments = []
+        shared_args = []
+        for arg in args:
+            if isinstance(arg, np.ndarray):
+                if (mapped := describeMapping(arg)) is not None:
+                    arg = mapped
+                else:
+                    segment, arg = shareArray(arg)
+                    segments.append(segment)
+            shared_args.append(arg)
+
+        try:
+            # A job whose pool broke is run once more on the new pool, it may only have shared the pool with the job that
+            # killed its worker. Failing again, it fails alone
+            for attempt in range(2):
+                pool = self.pool
+                try:
+                    future = pool.submit(runShared, func, tuple(shared_args), kwargs)
+                    result, cpu_time = await waitFuture(future)
+                    break
+                except BrokenProcessPool:
+                    self.replacePool(pool)
+                    if attempt:
+                        raise
+                except trio.Cancelled:
+                    if not future.cancel():
+                        future.add_done_callback(releaseFuture)
+                    raise
+        finally:
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+
+        if isinstance(result, tuple):
+            return tuple(collectArray(item) if isinstance(item, SharedArray) else item for item in result), cpu_time
+        return (collectArray(result) if isinstance(result, SharedArray) else result), cpu_time
+
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,69 @@
+import itertools
+import logging
+import json
+import trio
+
+
+class Subscription:
+    def __init__(self, task_ids: set, queue_size: int):
+        self.task_ids = task_ids
+        self.send_channel, self.receive_channel = trio.open_memory_channel(queue_size)
+        self.lagging = False
+
+
+class EventBroker:
+    # Fan-out of task events to /events subscribers. Publishing never waits: a subscriber whose queue is full
+    # is dropped and its stream is closed, the client reconnects and starts again from the current statuses
+    def __init__(self, config: dict, logger=logging.getLogger('EVENTS')):
+        self.logger = logger
+        self.queue_size = config['EVENTS']['queue_size']
+        self.keep_alive = config['EVENTS']['keep_alive']
+        self.progress_interval = config['EVENTS']['progress_interval']
+        self.subscriptions = dict()
+        self.sequence = itertools.count(1)
+
+
+    def subscribe(self, task_ids: set) -> Subscription:
+        subscription = Subscription(task_ids, self.queue_size)
+        for task_id in task_ids:
+            self.subscriptions.setdefault(task_id, set()).add(subscription)
+        return subscription
+
+
+    def unsubscribe(self, subscription: Subscription):
+        for task_id in subscription.task_ids:
+            subscribers = self.subscriptions.get(task_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscriptions[task_id]
+        subscription.send_channel.close()
+
+
+    def subscribers(self) -> int:
+        return len({subscription for subscribers in self.subscriptions.values() for subscription in subscribers})
+
+
+    def hasSubscribers(self, task_id: str) -> bool:
+        return task_id in self.subscriptions
+
+
+    def formatEvent(self, event: str, data: dict) -> bytes:
+        return f'id: {next(self.sequence)}\nevent: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+
+    def publish(self, task_id: str, event: str, data: dict):
+        subscribers = self.subscriptions.get(task_id)
+        if not subscribers:
+            return
+
+        message = self.formatEvent(event, {'id': task_id, **data})
+        for subscription in list(subscribers):
+            try:
+                subscription.send_channel.send_nowait((task_id, event, data, message))
+            except trio.WouldBlock:
+                self.logger.warning(f'Events subscriber of {len(subscription.task_ids)} tasks is too slow, closing its stream')
+                subscription.lagging = True
+                self.unsubscribe(subscription)
+            except trio.ClosedResourceError:
+                pass
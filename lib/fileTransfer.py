@@ -0,0 +1,89 @@
+import shutil
+import errno
+import os
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+
+# ioctl request of Linux that makes dst share the data extents of src (Btrfs, XFS with reflink=1, NFS 4.2 servers with clone support)
+FICLONE = 0x40049409
+
+
+def linkFile(src: str, dst: str):
+    os.link(src, dst)
+
+
+def cloneFile(src: str, dst: str):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, 'Reflinks are not supported on this platform')
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def copyFile(src: str, dst: str, chunk_size: int):
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        while chunk := src_file.read(chunk_size):
+            dst_file.write(chunk)
+    shutil.copystat(src, dst)
+
+
+def verifyCopy(src_stat: os.stat_result, src: str, dst: str):
+    # A source that changed while it was being copied, or a short copy, is never passed to the pipeline
+    if os.stat(src).st_mtime_ns != src_stat.st_mtime_ns:
+        raise OSError(f'{src} was modified during the copy')
+    dst_stat = os.stat(dst)
+    if dst_stat.st_size != src_stat.st_size or dst_stat.st_mtime_ns != src_stat.st_mtime_ns:
+        raise OSError(f'{dst} does not match the size and modification time of {src}')
+
+
+def ingestFile(src: str, dst: str, methods: list, chunk_size: int) -> str:
+    # Pipeline stages only read their input, so a hard link or a reflink is as good as a copy and costs no data I/O.
+    # Every method is tried in order, the name of the one that worked is returned
+    src_stat = os.stat(src)
+    error = None
+    for method in methods:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            if method == 'link':
+                linkFile(src, dst)
+            elif method == 'reflink':
+                cloneFile(src, dst)
+            elif method == 'copy':
+                copyFile(src, dst, chunk_size)
+            else:
+                raise ValueError(f'Unknown ingest method "{method}"')
+            verifyCopy(src_stat, src, dst)
+            return method
+        except OSError as e:
+            error = e
+    raise error if error else ValueError('No ingest method is configured')
+
+
+def placeFile(src: str, dst: str, mode: str):
+    # Hard links and renames only touch directory entries, a copy is made only across filesystems
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    try:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if mode == 'link':
+            os.link(src, dst)
+        else:
+            os.replace(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        shutil.copy2(src, dst)
+        if mode != 'link':
+            os.remove(src)
@@ -1,6 +1,148 @@
+import urllib.parse
 import logging
 import trio
-import json
+import re
+
+from http import HTTPStatus
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str = ''):
+        self.status = status
+        self.message = message or HTTPStatus(status).phrase
+
+    def __str__(self):
+        return self.message
+
+
+class Request:
+    def __init__(self, method: str, target: str, version: str, headers: dict, body: bytes = b''):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+        path, _, query = target.partition('?')
+        self.path = urllib.parse.unquote(path)
+        self.query = urllib.parse.parse_qs(query)
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+
+
+class HttpConnection:
+    # Wraps the client stream: handlers answer with respond(), which frames the response for keep-alive
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = bytearray()
+        self.request = None
+        self.keep_alive = False
+
+
+    async def receiveMore(self, max_size: int):
+        if len(self.buffer) > max_size:
+            raise HttpError(413)
+        data = await self.stream.receive_some(65536)
+        if not data:
+            raise trio.EndOfChannel
+        self.buffer += data
+
+
+    async def readLine(self, max_size: int) -> bytes:
+        while (end := self.buffer.find(b'\r\n')) < 0:
+            await self.receiveMore(max_size)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 2]
+        return line
+
+
+    async def readExactly(self, size: int, max_size: int) -> bytes:
+        if size > max_size:
+            raise HttpError(413)
+        while len(self.buffer) < size:
+            await self.receiveMore(max_size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+    async def readChunkedBody(self, max_size: int) -> bytes:
+        body = bytearray()
+        while True:
+            try:
+                size = int((await self.readLine(max_size)).split(b';', 1)[0], 16)
+            except ValueError:
+                raise HttpError(400, 'Bad chunk size')
+
+            if size == 0:
+                while await self.readLine(max_size):
+                    pass
+                return bytes(body)
+
+            body += await self.readExactly(size, max_size - len(body))
+            await self.readLine(max_size)
+
+
+    async def readRequest(self, max_header_size: int, max_body_size: int) -> Request:
+        while (end := self.buffer.find(b'\r\n\r\n')) < 0:
+            if len(self.buffer) > max_header_size:
+                raise HttpError(431)
+            await self.receiveMore(max_header_size)
+
+        head = self.buffer[:end].decode('latin-1').split('\r\n')
+        del self.buffer[:end + 4]
+
+        try:
+            method, target, version = head[0].split(' ', 2)
+            headers = {name.strip().lower(): value.strip() for name, value in (line.split(':', 1) for line in head[1:] if line)}
+            # int() would also accept signs and surrounding whitespace, the length has to be plain digits
+            length = headers.get('content-length', '0')
+            if not length.isdigit():
+                raise ValueError
+            length = int(length)
+        except ValueError:
+            raise HttpError(400, 'Malformed request head')
+
+        if length > max_body_size:
+            raise HttpError(413)
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = await self.readChunkedBody(max_body_size)
+        else:
+            body = await self.readExactly(length, max_body_size)
+
+        self.request = Request(method, target, version, headers, body)
+        self.keep_alive = self.request.keep_alive
+        return self.request
+
+
+    async def respond(self, status: int, body='', headers: dict = None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        head = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}', f'Content-Length: {len(body)}', f'Connection: {"keep-alive" if self.keep_alive else "close"}']
+        head += [f'{name}: {value}' for name, value in (headers or {}).items()]
+
+        await self.stream.send_all(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+
+
+    async def respondStream(self, status: int, headers: dict = None):
+        # Head of an unframed response whose body is sent with send_all until the connection is closed
+        self.keep_alive = False
+        head = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}', 'Connection: close']
+        head += [f'{name}: {value}' for name, value in (headers or {}).items()]
+
+        await self.stream.send_all(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+
+    async def send_all(self, data: bytes):
+        # Raw responses carry no framing, so the connection can not be reused after them
+        self.keep_alive = False
+        await self.stream.send_all(data)
+
 
 class HttpServer:
     routes = {}
@@ -8,9 +150,14 @@ class HttpServer:
     def __init__(self, task_manager, config, logger=logging.getLogger('HTTP')):
         self.task_manager = task_manager
         self.logger = logger
-        self.config = config 
+        self.config = config
+        self.keep_alive_timeout = config['HTTP']['keep_alive_timeout']
+        self.request_timeout = config['HTTP']['request_timeout']
+        self.max_header_size = config['HTTP']['max_header_kb'] * 1024
+        self.max_body_size = config['HTTP']['max_body_kb'] * 1024
+        self.compileRoutes()
 
-    @classmethod 
+    @classmethod
     def route(self, method, path):
         def decorator(f):
             self.routes[(method, path)] = f
@@ -18,48 +165,86 @@ class HttpServer:
         return decorator
 
 
-    async def handleRequest(self, stream):
-        data = await stream.receive_some(2048)
-        
-        try:
-            headers, body = data.decode('utf-8').split('\r\n\r\n', 1)
-        except:
-            self.logger.error(f'Error while trying to decode the data')
+    def compileRoutes(self):
+        # Static paths are a single dict lookup, paths with {parameters} are matched by precompiled regexes
+        self.static_routes = {}
+        self.pattern_routes = {}
+
+        for (method, path), handler in self.routes.items():
+            if '{' in path:
+                pattern = re.compile(re.sub(r'\\\{(\w+)\\\}', r'(?P<\1>[^/]+)', re.escape(path)) + '$')
+                self.pattern_routes.setdefault(method, []).append((pattern, handler))
+            else:
+                self.static_routes[(method, path)] = handler
+
+
+    def findRoute(self, method: str, path: str) -> (object, dict):
+        if handler := self.static_routes.get((method, path)):
+            return handler, {}
+
+        for pattern, handler in self.pattern_routes.get(method, []):
+            if match := pattern.match(path):
+                return handler, match.groupdict()
+
+        return None, {}
+
+
+    async def handleRequest(self, connection: HttpConnection, request: Request):
+        handler, path_args = self.findRoute(request.method, request.path)
+
+        if not handler:
+            self.logger.info(f'Unknown {request.method} {request.path} request')
+            await connection.respond(404)
             return
 
-        #self.logger.debug(f'Headers: {headers}; Body: {body}')
+        try:
+            body = request.body.decode('utf-8')
+        except UnicodeDecodeError:
+            self.logger.error(f'Bad {request.method} {request.path} request: body is not UTF-8. Send 400')
+            await connection.respond(400, 'Request body is not valid UTF-8\n')
+            return
 
-        method, path, _ = headers.split('\r\n')[0].split(' ', 2)
-        path_splitted = path.split('/')[1:]
-        path_args = {}
+        self.logger.info(f'Start handling {request.method} {request.path} request')
+        try:
+            await handler(self, connection, path_args, body)
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            raise
+        except Exception as e:
+            self.logger.error(f'Error in {request.method} {request.path} handler: {str(e)}')
+            connection.keep_alive = False
+            await connection.respond(500, f'Error: {str(e)}\n')
 
-        for route, handler in self.routes.items():
-            route_method, route_path = route
-            if method != route_method:
-                continue
 
-            route_path_parts = route_path.split('/')[1:]
-            if len(path_splitted) != len(route_path_parts):
-                continue
+    async def handleConnection(self, stream):
+        connection = HttpConnection(stream)
+        try:
+            while True:
+                with trio.move_on_after(self.keep_alive_timeout):
+                    if not connection.buffer:
+                        await connection.receiveMore(self.max_header_size)
+                if not connection.buffer:
+                    return
 
-            for route_part, path_part in zip(route_path_parts, path_splitted):
-                if route_part.startswith('{') and route_part.endswith('}'):
-                    path_args[route_part[1:-1]] = path_part
-                elif route_part != path_part:
-                    break
-            else:
-                self.logger.info(f'Start handling {method} {path} request')
                 try:
-                    await handler(self, stream, path_args, body)
-                except Exception as e:
-                    await stream.send_all(f'HTTP/1.0 500 Internal Server Error\r\n\r\nError: {str(e)}\n'.encode('utf-8'))
-                return
-
+                    with trio.fail_after(self.request_timeout):
+                        request = await connection.readRequest(self.max_header_size, self.max_body_size)
+                except HttpError as e:
+                    self.logger.error(f'Bad request: {str(e)}. Send {e.status}')
+                    connection.keep_alive = False
+                    await connection.respond(e.status, f'{str(e)}\n')
+                    return
 
-        self.logger.info(f'Unknown {method} {path} request')
-        await stream.send_all(b'HTTP/1.0 404 Not Found\r\n\r\n')
+                await self.handleRequest(connection, request)
+                if not connection.keep_alive:
+                    return
+        except (trio.EndOfChannel, trio.TooSlowError, trio.BrokenResourceError, trio.ClosedResourceError):
+            pass
+        except Exception as e:
+            self.logger.error(f'Connection error: {str(e)}')
+        finally:
+            await stream.aclose()
 
 
     async def run(self):
         self.logger.info(f"HTTP server is running on port {self.config['MAIN']['port']}")
-        await trio.serve_tcp(self.handleRequest, self.config['MAIN']['port'])
+        await trio.serve_tcp(self.handleConnection, self.config['MAIN']['port'])
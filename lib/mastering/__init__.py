@@ -1,6 +1,33 @@
 from .audioProcessor import (
+    equalize,
+    compress,
+    normalize,
+    resample,
+    matchReference,
+    analyzeReference,
+    analyzeReferenceFile,
+    ReferenceAnalysis,
     equalizeFile,
     compressFile,
     normalizeFile,
-    byReference 
+    byReference,
+    verifyFormat,
+    verifySampleRate,
+    AudioProcessorError
+)
+from .audioIO import (
+    readAudio,
+    writeAudio,
+    getFormat,
+    getDuration,
+    getSampleRate
+)
+from .streaming import (
+    isStreamable,
+    equalizeStream,
+    compressStream,
+    normalizeStream,
+    matchReferenceStream,
+    analyzeReferenceStream,
+    writeStream
 )
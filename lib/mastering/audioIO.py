@@ -0,0 +1,146 @@
+from pydub import AudioSegment
+import soundfile as sf
+import numpy as np
+import struct
+import os
+
+
+# libsndfile >= 1.1 decodes and encodes MP3 itself, older builds go through pydub/ffmpeg
+soundfile_formats = {name.lower() for name in sf.available_formats()}
+
+# Formats a client can request for the delivered file
+output_formats = ('wav', 'flac', 'ogg', 'mp3')
+
+# Sample rates a client can request for the delivered file
+min_output_sample_rate = 8000
+max_output_sample_rate = 192000
+
+# Sample layouts of uncompressed WAV and RF64 files that numpy can map as they are, by (format tag, bits per sample)
+wav_sample_types = {(1, 16): np.dtype('<i2'), (1, 32): np.dtype('<i4'), (3, 32): np.dtype('<f4'), (3, 64): np.dtype('<f8')}
+wav_write_block_size = 65536
+# Sub-format GUID of PCM in a WAVE_FORMAT_EXTENSIBLE header, written for more than two channels
+wav_pcm_guid = b'\x01\x00\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+
+
+def getFormat(path: str) -> str:
+    return path.split('.')[-1].lower()
+
+
+def getDuration(path: str) -> float:
+    # Read from the file header, nothing is decoded
+    return sf.info(path).duration
+
+
+def getSampleRate(path: str) -> int:
+    return sf.info(path).samplerate
+
+
+def toSegment(data: np.ndarray, rate: int) -> AudioSegment:
+    samples = np.int16(np.clip(data, -1.0, 1.0) * 32767)
+    return AudioSegment(samples.tobytes(), frame_rate=rate, sample_width=2, channels=samples.shape[1])
+
+
+def fromSegment(segment: AudioSegment, dtype=np.float32) -> (np.ndarray, int):
+    samples = np.array(segment.get_array_of_samples()).reshape(-1, segment.channels)
+    data = samples.astype(dtype) / (1 << (8 * segment.sample_width - 1))
+    return data, segment.frame_rate
+
+
+def getWAVLayout(path: str) -> (int, np.dtype, int, int, int):
+    # Offset of the samples, their dtype, frames, channels and sample rate, or None for files that can not be mapped
+    with open(path, 'rb') as file:
+        header = file.read(12)
+        if len(header) < 12 or header[:4] not in (b'RIFF', b'RF64') or header[8:] != b'WAVE':
+            return None
+
+        sample_type, data_size_64 = None, None
+        while len(chunk := file.read(8)) == 8:
+            chunk_id, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+            if chunk_id == b'data':
+                if sample_type is None:
+                    return None
+                if size == 0xFFFFFFFF and data_size_64 is not None:
+                    size = data_size_64
+                # A file that is still being written or was cut short has fewer samples than its header says
+                size = min(size, os.fstat(file.fileno()).st_size - file.tell())
+                return file.tell(), sample_type, size // block_align, channels, rate
+
+            body = file.read(size + (size & 1))
+            if chunk_id == b'ds64':
+                data_size_64 = struct.unpack('<Q', body[8:16])[0]
+            elif chunk_id == b'fmt ':
+                tag, channels, rate, _, block_align, bits = struct.unpack('<HHIIHH', body[:16])
+                if tag == 0xFFFE:
+                    tag = struct.unpack('<H', body[24:26])[0]
+                sample_type = wav_sample_types.get((tag, bits))
+                if sample_type is None or block_align != channels * sample_type.itemsize:
+                    return None
+    return None
+
+
+def mapAudio(path: str) -> (np.ndarray, int):
+    # Samples of uncompressed WAV files are mapped read-only as they are stored instead of decoded, so the page cache
+    # holds them and not the heap. None when the file has another format or sample type
+    layout = getWAVLayout(path) if getFormat(path) == 'wav' else None
+    if layout is None or not layout[2]:
+        return None
+
+    offset, sample_type, frames, channels, rate = layout
+    return np.asarray(np.memmap(path, sample_type, 'r', offset, (frames, channels))), rate
+
+
+def toFloat(samples: np.ndarray, dtype=np.float32) -> np.ndarray:
+    # Same values as libsndfile decodes: integer samples are divided by 2 ** (bits - 1), samples already of dtype are not copied
+    if samples.dtype.kind == 'f':
+        return samples.astype(dtype, copy=False)
+    return samples.astype(dtype) * np.dtype(dtype).type(1 / 2 ** (8 * samples.dtype.itemsize - 1))
+
+
+def createWAV(path: str, frames: int, channels: int, rate: int) -> np.memmap:
+    # 16-bit PCM, the default WAV subtype of libsndfile. The file is allocated at its full size and mapped for writing
+    data_size = frames * channels * 2
+    extensible = channels > 2
+    fmt = struct.pack('<HHIIHH', 0xFFFE if extensible else 1, channels, rate, rate * channels * 2, channels * 2, 16)
+    if extensible:
+        fmt += struct.pack('<HHI', 22, 16, 0) + wav_pcm_guid
+
+    with open(path, 'wb') as file:
+        file.write(b'RIFF' + struct.pack('<I', 4 + 8 + len(fmt) + 8 + data_size) + b'WAVE')
+        file.write(b'fmt ' + struct.pack('<I', len(fmt)) + fmt)
+        file.write(b'data' + struct.pack('<I', data_size))
+        offset = file.tell()
+        file.truncate(offset + data_size)
+    return np.memmap(path, '<i2', 'r+', offset, (frames, channels))
+
+
+def writeMappedWAV(path: str, data: np.ndarray, rate: int):
+    # Same samples as sf.write, one block at a time: libsndfile rounds to 32 bits and keeps the upper 16
+    output = createWAV(path, data.shape[0], data.shape[1], rate)
+    for start in range(0, data.shape[0], wav_write_block_size):
+        block = np.rint(np.clip(data[start:start + wav_write_block_size], -1.0, 1.0).astype(np.float64) * 2**31)
+        output[start:start + wav_write_block_size] = np.minimum(block, 2**31 - 1).astype(np.int64) >> 16
+    output.flush()
+    del output
+
+
+def readAudio(path: str, dtype=np.float32) -> (np.ndarray, int):
+    if getFormat(path) not in soundfile_formats:
+        return fromSegment(AudioSegment.from_file(path, getFormat(path)), dtype)
+
+    if (mapped := mapAudio(path)) is not None:
+        samples, rate = mapped
+        return toFloat(samples, dtype), rate
+
+    data, rate = sf.read(path, dtype=dtype, always_2d=True)
+    return data, rate
+
+
+def writeAudio(path: str, data: np.ndarray, rate: int) -> str:
+    if getFormat(path) not in soundfile_formats:
+        toSegment(data, rate).export(path, format=getFormat(path))
+    elif getFormat(path) == 'wav' and 0 < data.size * 2 < 0xFFFFFFFF - 64:
+        writeMappedWAV(path, data, rate)
+    else:
+        sf.write(path, np.clip(data, -1.0, 1.0), rate)
+
+    return path
@@ -1,19 +1,15 @@
-from pydub import AudioSegment, effects
-from scipy.io import wavfile
 from scipy import signal
-import soundfile as sf
 import numpy as np
 import logging
 
 from . import validator
+from . import audioIO
 from . import audioProcessorUtils as apu
 
 
-convertion_funcs = {
-    'wav': AudioSegment.from_wav,
-    'mp3': AudioSegment.from_mp3,
-    'ogg': AudioSegment.from_ogg
-}
+normalization_headroom = 0.1
+compressor_block_size = 65536
+equalizer_block_size = 65536
 
 
 class AudioProcessorError(Exception):
@@ -24,143 +20,162 @@ class AudioProcessorError(Exception):
         return self.message
 
 
-def __verifyFormat(name: str):
-    if name not in convertion_funcs.keys():
+def verifyFormat(name: str):
+    if name not in audioIO.output_formats:
         raise AudioProcessorError("Format '%s' is not supported" % name)
 
 
-def __convertFile(path: str, output_format: str):
-    input_format = path.split('.')[-1]
-    
-    __verifyFormat(input_format)
-    __verifyFormat(output_format)
-    
-    new_path = path.rsplit('.', 1)[0] + '.' + output_format
-    
-    output_signal = convertion_funcs[input_format](path)
-    output_signal = output_signal.normalize()
-    output_signal.export(new_path, format=output_format)    
-  
-    return new_path
-
-
-def __workingInFormat(target_format):
-    def prepareFileForFunction(func):
-        def preparator(*args, **kwargs):
-            path = args[0]
-            current_format = path.split('.')[-1]
-            convertion_is_required = True if current_format != target_format else False
-
-            if convertion_is_required:
-                path = __convertFile(path, target_format)
-            
-            path = func(path, *args[1:], **kwargs)
-
-            if convertion_is_required:
-                path = __convertFile(path, current_format)
-            
-            return path
-        return preparator
-    return prepareFileForFunction
-
-
-@__workingInFormat("wav")
-def equalizeFile(path: str, eq_dict: dict): #test dictionary = {200: 10, 1000: -10, 5000: -10}
-    rate, data = wavfile.read(path)
-
-    if len(data.shape) > 1 and data.shape[1] > 1:
-        data_left = data[:, 0]
-        data_right = data[:, 1]
-    else:
-        data_left = data_right = data
+def verifySampleRate(rate: int):
+    if not isinstance(rate, int) or isinstance(rate, bool) or not audioIO.min_output_sample_rate <= rate <= audioIO.max_output_sample_rate:
+        raise AudioProcessorError("Sample rate '%s' is not supported" % rate)
 
-    output_signal_left = np.array(data_left, dtype=np.float64)
-    output_signal_right = np.array(data_right, dtype=np.float64)
 
-    for freq in eq_dict.keys():
-        gain_db = eq_dict[freq]
-        gain = 10**(gain_db/20)
+def equalize(data: np.ndarray, rate: int, eq_dict: dict) -> (np.ndarray, int): #test dictionary = {200: 10, 1000: -10, 5000: -10}
+    sos = apu.designEqualizer(rate, tuple(eq_dict.items()))
 
-        b, a = signal.butter(2, [0.9*freq, 1.1*freq], 'bandpass', fs=rate)
+    output_signal = np.array(data)
 
-        band_left = signal.filtfilt(b, a, data_left)
-        band_right = signal.filtfilt(b, a, data_right)
+    # Low-frequency peaking sections have poles close to the unit circle and lose about 20 dB of SNR when they
+    # run in float32, so the filter works in float64 one block at a time and the output keeps the dtype of the audio
+    if len(sos):
+        zi = np.zeros((sos.shape[0], 2, data.shape[1]))
+        peaks = np.zeros(data.shape[1])
+        for start in range(0, data.shape[0], equalizer_block_size):
+            block, zi = signal.sosfilt(sos, data[start:start + equalizer_block_size], axis=0, zi=zi)
+            peaks = np.maximum(peaks, np.max(np.abs(block), axis=0))
+            output_signal[start:start + equalizer_block_size] = block
+    else:
+        peaks = np.max(np.abs(output_signal), axis=0)
 
-        output_signal_left += gain * band_left - band_left
-        output_signal_right += gain * band_right - band_right
+    output_signal /= np.where(peaks > 0, peaks, 1.0).astype(data.dtype)
 
-    output_signal_left /= np.max(np.abs(output_signal_left))
-    output_signal_right /= np.max(np.abs(output_signal_right))
+    return output_signal, rate
 
-    output_signal = np.vstack((output_signal_left, output_signal_right)).T
 
-    output_signal = np.int16(output_signal * 32767)
+def compress(data: np.ndarray, rate: int, *, threshold = -20.0, ratio = 4.0, attack = 5.0, release = 50.0, knee = 0.0, makeup = 0.0) -> (np.ndarray, int):
+    attack_coefficient = apu.getSmoothingCoefficient(rate, attack)
+    release_coefficient = apu.getSmoothingCoefficient(rate, release)
+    makeup_gain = 10**(makeup/20)
 
-    new_path = path.rsplit('.', 1)[0] + '_eq.' + path.split('.')[-1]
-    wavfile.write(new_path, rate, output_signal)
-    return new_path
+    output_signal = np.empty_like(data)
+    state = (0.0, np.zeros(1))
 
+    for start in range(0, data.shape[0], compressor_block_size):
+        block = data[start:start + compressor_block_size]
+        output_signal[start:start + compressor_block_size], state = apu.compressBlock(block, threshold, ratio, knee, makeup_gain, attack_coefficient, release_coefficient, state)
 
-def compressFile(path: str, *, threshold = -20.0, ratio = 4.0, attack = 5.0, release = 50.0):
-    input_signal = AudioSegment.from_file(path, path.split('.')[-1])
-    output_signal = input_signal.compress_dynamic_range(threshold=threshold, ratio=ratio, attack=attack, release=release)
-    
-    new_path = path.rsplit('.', 1)[0] + '_comp.'+ path.split('.')[-1]
-    output_signal.export(new_path)
-
-    return new_path
+    return output_signal, rate
 
 
-def normalizeFile(path: str, dBFS=None):
-    input_signal = AudioSegment.from_file(path, path.split('.')[-1])
-    
+def normalize(data: np.ndarray, rate: int, dBFS=None) -> (np.ndarray, int):
     if not dBFS:
-        output_signal = effects.normalize(input_signal)
+        peak = np.max(np.abs(data))
+        gain = 10**(-normalization_headroom/20) / peak if peak else 1.0
     else:
-        delta_dBFS = dBFS - input_signal.dBFS
-        output_signal = input_signal.apply_gain(delta_dBFS)
+        rms = np.sqrt(np.mean(np.square(data, dtype=np.float64)))
+        delta_dBFS = dBFS - 20*np.log10(rms) if rms else 0.0
+        gain = 10**(delta_dBFS/20)
 
-    new_path = path.rsplit('.', 1)[0] + '_norm.'+ path.split('.')[-1]
-    output_signal.export(new_path)
-    
-    return new_path
+    return (data * gain).astype(data.dtype), rate
 
 
-def byReference(targetTrack: str, referenceTrack: str):
-    
-    targ_data, targ_rate  = sf.read(targetTrack, always_2d=True)
-    ref_data, ref_rate = sf.read(referenceTrack, always_2d=True)
+def resample(data: np.ndarray, rate: int, output_rate: int, resampling: str = 'quality') -> (np.ndarray, int):
+    # Stages run at the native rate of the input, only the delivered result is resampled on request
+    return validator.checkSampleRate(data, rate, output_rate, resampling)
 
-    targ_data, targ_rate = validator.check(targ_data, targ_rate)
-    ref_data, ref_rate = validator.check(ref_data, ref_rate)
 
-    targ_mid, targ_side = apu.convertFromLeftRightToMidSide(targ_data) 
-    targ_pieces_quantity, targ_piece_size = apu.calculatePiecesParams(targ_mid, targ_rate)
-    targ_loudest_RMS, targ_mid_loudest_pieces, targ_side_loudest_pieces = apu.getLoudestMidSidePieces(targ_mid, targ_side, targ_pieces_quantity, targ_piece_size)
+class ReferenceAnalysis:
+    # Spectra are on the bins of apu.getFFTSize(rate) and only match targets of that rate, side_fft is empty for a mono reference
+    def __init__(self, loudest_RMS: float, mid_fft: np.ndarray, side_fft: np.ndarray, rate: int = 44100):
+        self.loudest_RMS = loudest_RMS
+        self.mid_fft = mid_fft
+        self.side_fft = side_fft
+        self.rate = rate
+
+
+def analyzeReference(ref_data: np.ndarray, ref_rate: int, rate: int = None, resampling: str = 'quality') -> ReferenceAnalysis:
+    # A reference of another rate is resampled to the rate of the target first, so both spectra describe the same content
+    if rate and rate != ref_rate:
+        ref_data, ref_rate = resample(ref_data, ref_rate, rate, resampling)
 
-    ref_mid, ref_side = apu.convertFromLeftRightToMidSide(ref_data) 
+    fft_size = apu.getFFTSize(ref_rate)
+    ref_data, ref_rate = validator.check(ref_data, ref_rate, fft_size=fft_size)
+
+    ref_mid, ref_side = apu.convertToMidSide(ref_data)
     ref_pieces_quantity, ref_piece_size = apu.calculatePiecesParams(ref_mid, ref_rate)
     ref_loudest_RMS, ref_mid_loudest_pieces, ref_side_loudest_pieces = apu.getLoudestMidSidePieces(ref_mid, ref_side, ref_pieces_quantity, ref_piece_size)
 
-    rms_coefficient, targ_mid, targ_side = apu.calculateCoefficientAndAmplify(targ_mid, targ_side, targ_loudest_RMS, ref_loudest_RMS)    
+    ref_side_fft = apu.averageFFT(ref_side_loudest_pieces, fft_size) if ref_side.shape[1] else np.zeros(0)
+    return ReferenceAnalysis(ref_loudest_RMS, apu.averageFFT(ref_mid_loudest_pieces, fft_size), ref_side_fft, ref_rate)
+
+
+def analyzeReferenceFile(referenceTrack: str, dtype=np.float32, rate: int = None, resampling: str = 'quality') -> ReferenceAnalysis:
+    return analyzeReference(*audioIO.readAudio(referenceTrack, dtype), rate, resampling)
+
+
+def checkReferenceRate(reference: ReferenceAnalysis, rate: int):
+    if reference.rate != rate:
+        raise AudioProcessorError("Reference is analysed at %s Hz, the target is at %s Hz" % (reference.rate, rate))
+
+
+def matchReference(targ_data: np.ndarray, targ_rate: int, reference: ReferenceAnalysis) -> (np.ndarray, int):
+    checkReferenceRate(reference, targ_rate)
+    targ_data, targ_rate = validator.check(targ_data, targ_rate, fft_size=apu.getFFTSize(targ_rate))
+
+    targ_mid, targ_side = apu.convertToMidSide(targ_data)
+    targ_pieces_quantity, targ_piece_size = apu.calculatePiecesParams(targ_mid, targ_rate)
+    targ_loudest_RMS, targ_mid_loudest_pieces, targ_side_loudest_pieces = apu.getLoudestMidSidePieces(targ_mid, targ_side, targ_pieces_quantity, targ_piece_size)
+
+    rms_coefficient, targ_mid, targ_side = apu.calculateCoefficientAndAmplify(targ_mid, targ_side, targ_loudest_RMS, reference.loudest_RMS)    
 
     targ_mid_loudest_pieces *= rms_coefficient
     targ_side_loudest_pieces *= rms_coefficient
 
-    mid_fir = apu.getFIR(targ_mid_loudest_pieces, ref_mid_loudest_pieces)
-    side_fir = apu.getFIR(targ_side_loudest_pieces, ref_side_loudest_pieces)
+    mid_fir = apu.getFIR(targ_mid_loudest_pieces, reference.mid_fft, targ_rate)
+    # A mono reference has no side spectrum, the side of the target then gets the same correction as its mid
+    if targ_side.shape[1] and len(reference.side_fft):
+        side_fir = apu.getFIR(targ_side_loudest_pieces, reference.side_fft, targ_rate)
+    else:
+        side_fir = mid_fir
 
     result, result_mid = apu.convolve(targ_mid, mid_fir, targ_side, side_fir)
 
     for rms_step in range(1, 5):
         result_clipped = np.clip(result_mid, -1.0, 1.0)
         targ_loudest_RMS, *_ = apu.getLoudestMidSidePieces(result_clipped, targ_side, targ_pieces_quantity, targ_piece_size)
-        *_, result = apu.calculateCoefficientAndAmplify(result_mid, result, targ_loudest_RMS, ref_loudest_RMS)
+        *_, result = apu.calculateCoefficientAndAmplify(result_mid, result, targ_loudest_RMS, reference.loudest_RMS)
 
+    return result, targ_rate
 
-    new_path = targetTrack.rsplit('.', 1)[0] + '_mastered.'+ targetTrack.split('.')[-1]
-    sf.write(new_path, result, targ_rate)
 
-    return new_path
+def equalizeFile(path: str, eq_dict: dict, dtype=np.float32):
+    data, rate = audioIO.readAudio(path, dtype)
+    data, rate = equalize(data, rate, eq_dict)
 
+    new_path = path.rsplit('.', 1)[0] + '_eq.' + path.split('.')[-1]
+    return audioIO.writeAudio(new_path, data, rate)
 
+
+def compressFile(path: str, dtype=np.float32, **compression_params):
+    data, rate = audioIO.readAudio(path, dtype)
+    data, rate = compress(data, rate, **compression_params)
+    
+    new_path = path.rsplit('.', 1)[0] + '_comp.'+ path.split('.')[-1]
+    return audioIO.writeAudio(new_path, data, rate)
+
+
+def normalizeFile(path: str, dBFS=None, dtype=np.float32):
+    data, rate = audioIO.readAudio(path, dtype)
+    data, rate = normalize(data, rate, dBFS)
+
+    new_path = path.rsplit('.', 1)[0] + '_norm.'+ path.split('.')[-1]
+    return audioIO.writeAudio(new_path, data, rate)
+
+
+def byReference(targetTrack: str, referenceTrack: str, dtype=np.float32):
+    targ_data, targ_rate = audioIO.readAudio(targetTrack, dtype)
+
+    result, targ_rate = matchReference(targ_data, targ_rate, analyzeReferenceFile(referenceTrack, dtype, targ_rate))
+
+    new_path = targetTrack.rsplit('.', 1)[0] + '_mastered.'+ targetTrack.split('.')[-1]
+    return audioIO.writeAudio(new_path, result, targ_rate)
@@ -1,32 +1,31 @@
 import numpy as np
-from scipy import signal, interpolate
-import statsmodels.api as sm
-
-def convertFromLeftRightToMidSide(data: np.ndarray) -> (np.ndarray, np.ndarray):
-    data = np.copy(data)
-    data[:, 0] += data[:, 1]
-    data[:, 0] *= 0.5
-    mid_data = np.copy(data[:, 0])
-    data[:, 0] -= data[:, 1]
-    side_data = np.copy(data[:, 0])
-    print(mid_data, side_data)
-    print(mid_data.shape, side_data.shape)
+from functools import lru_cache
+from scipy import signal, interpolate, sparse, linalg
+
+def convertToMidSide(data: np.ndarray) -> (np.ndarray, np.ndarray):
+    # Mid is the mean of all channels and side holds every channel but the last minus the mid, the last one
+    # follows from the others. For stereo these are the usual (L + R) / 2 and (L - R) / 2, mono has no side
+    mid_data = data.mean(axis=1, dtype=data.dtype)
+    side_data = data[:, :-1] - mid_data[:, None]
     return mid_data, side_data
 
 
-def convertFromMidSideToLeftRight(mid_data: np.ndarray, side_data: np.ndarray) -> np.ndarray:
-    return np.vstack((mid_data + side_data, mid_data - side_data)).T
+def convertFromMidSide(mid_data: np.ndarray, side_data: np.ndarray) -> np.ndarray:
+    return np.vstack(((mid_data[:, None] + side_data).T, mid_data - side_data.sum(axis=1))).T
 
 
 def calculatePiecesParams(data: np.ndarray, rate: int, max_piece_duration=15) -> (int, int):
-    data_size = data.shape[0]
+    return calculatePiecesParamsByLength(data.shape[0], rate, max_piece_duration)
+
+
+def calculatePiecesParamsByLength(data_size: int, rate: int, max_piece_duration=15) -> (int, int):
     quantity = int(data_size / (max_piece_duration*rate)) + 1
     piece_size = int(data_size / quantity)
     return quantity, piece_size
 
 
 def divideIntoPieces(data: np.ndarray, quantity: int, piece_size: int) -> np.ndarray:
-    return data[: piece_size * quantity].reshape(-1, piece_size)
+    return data[: piece_size * quantity].reshape(quantity, piece_size, *data.shape[1:])
 
 
 def getRMSes(data: np.ndarray) -> np.ndarray:
@@ -55,13 +54,15 @@ def getLoudestMidSidePieces(mid: np.ndarray, side: np.ndarray, quantity: int, pi
     loudest_average_RMS = getRMS(RMSes[loudest_indexes]) #match_rms
 
     mid_loudest_pieces = mid_pieces[loudest_indexes]
-    side_loudest_pieces = side_pieces[loudest_indexes]
+    # Side channels go first, so every channel is a batch of pieces for averageFFT
+    side_loudest_pieces = np.moveaxis(side_pieces[loudest_indexes], -1, 0)
 
     return loudest_average_RMS, mid_loudest_pieces, side_loudest_pieces
 
 
 def calculateCoefficientAndAmplify(data_main: np.ndarray, data_additional: np.ndarray, target_main_match_rms: float, reference_match_rms: float) -> (float, np.ndarray, np.ndarray):
-    rms_coefficient = reference_match_rms / target_main_match_rms
+    # A Python float does not promote float32 audio to float64
+    rms_coefficient = float(reference_match_rms / target_main_match_rms)
 
     data_main = data_main * rms_coefficient
     data_additional = data_additional * rms_coefficient
@@ -69,33 +70,121 @@ def calculateCoefficientAndAmplify(data_main: np.ndarray, data_additional: np.nd
     return rms_coefficient, data_main, data_additional
 
 
-def smoothLowess(fft_data: np.ndarray, frac = 0.0375, it = 0, delta = 0.001) -> np.ndarray:
-    lowess_smooth = sm.nonparametric.lowess(fft_data, np.linspace(0, 1, len(fft_data)), frac=frac, it=it, delta=delta)[:, 1]
+@lru_cache(maxsize=4)
+def getLowessMatrix(size: int, frac: float, delta: float) -> sparse.csr_matrix:
+    # lowess of statsmodels without robustifying iterations is linear in y, so for a fixed x grid
+    # its local regressions (and the delta interpolation between them) collapse into one sparse matrix
+    x = np.linspace(0, 1, size)
+    k = min(max(int(frac * size + 1e-10), 2), size)
+    rows = [None] * size
 
-    return lowess_smooth
+    i, last_fit_i = 0, -1
+    left_end, right_end = 0, k
+    while True:
+        xval = x[i]
+        while right_end < size and xval > (x[left_end] + x[right_end]) / 2:
+            left_end += 1
+            right_end += 1
+        radius = max(xval - x[left_end], x[right_end - 1] - xval)
 
+        neighbours = x[left_end:right_end]
+        weights = (1 - (np.abs(neighbours - xval) / radius)**3)**3
+        weights /= weights.sum()
+        weighted_x = weights @ neighbours
+        weighted_sqdev_x = max(weights @ (neighbours - weighted_x)**2, 1e-12)
+        rows[i] = (left_end, weights * (1 + (xval - weighted_x) * (neighbours - weighted_x) / weighted_sqdev_x))
 
-def averageFFT(loudest_pieces: np.ndarray) -> np.ndarray:
+        for skipped in range(last_fit_i + 1, i):
+            a = (x[skipped] - x[last_fit_i]) / (x[i] - x[last_fit_i])
+            rows[skipped] = combineRows(rows[last_fit_i], 1 - a, rows[i], a)
 
-    *_, specs = signal.stft(loudest_pieces, fs=44100, window="boxcar", nperseg=4096, noverlap=0, boundary=None, padded=False)
-    fft_average = np.abs(specs).mean((0, 2))
-    
-    return fft_average
+        last_fit_i = next_i = i
+        for next_i in range(last_fit_i + 1, size):
+            if x[next_i] > x[last_fit_i] + delta:
+                break
+        if last_fit_i >= size - 1:
+            break
+        i = max(next_i - 1, last_fit_i + 1)
+
+    indptr = np.cumsum([0] + [len(values) for _, values in rows])
+    indices = np.concatenate([np.arange(start, start + len(values)) for start, values in rows])
+    return sparse.csr_matrix((np.concatenate([values for _, values in rows]), indices, indptr), shape=(size, size))
+
+
+def combineRows(first: tuple, first_weight: float, second: tuple, second_weight: float) -> tuple:
+    (first_start, first_values), (second_start, second_values) = first, second
+    combined = np.zeros(second_start + len(second_values) - first_start)
+    combined[:len(first_values)] += first_weight * first_values
+    combined[second_start - first_start:] += second_weight * second_values
+    return first_start, combined
+
+
+def smoothLowess(fft_data: np.ndarray, frac = 0.0375, delta = 0.001) -> np.ndarray:
+    return getLowessMatrix(len(fft_data), frac, delta) @ fft_data
+
+
+class AnalysisPlan:
+    # Everything the spectrum analysis derives from (rate, fft size, oversampling) alone: the smoothing grids,
+    # the cubic spline interpolation between them as sparse operators, and the FIR window
+    def __init__(self, rate: int, fft_size: int, lin_log_oversampling: int):
+        self.rate = rate
+        self.fft_size = fft_size
+
+        self.grid_linear = rate * 0.5 * np.linspace(0, 1, fft_size // 2 + 1)
+        self.grid_logarithmic = rate * 0.5 * np.logspace(np.log10(4 / fft_size), 0, (fft_size // 2) * lin_log_oversampling + 1)
+
+        self.to_logarithmic = getSplineOperator(self.grid_linear, self.grid_logarithmic, False)
+        self.to_linear = getSplineOperator(self.grid_logarithmic, self.grid_linear, True)
 
+        self.fir_window = signal.windows.hann(fft_size)
 
-def smoothExponentially(matching_fft: np.ndarray, lin_log_oversampling = 4) -> np.ndarray:
-    grid_linear = (44100 * 0.5 * np.linspace(0, 1, 4096 // 2 + 1))
 
-    grid_logarithmic = (44100 * 0.5 * np.logspace(np.log10(4 / 4096), 0, (4096 // 2) * lin_log_oversampling + 1))
+def getSplineOperator(x: np.ndarray, x_new: np.ndarray, extrapolate: bool) -> (tuple, np.ndarray, sparse.csr_matrix):
+    # The not-a-knot cubic spline of interp1d is linear in y: its coefficients solve a banded collocation system
+    # that only depends on x, and evaluating it at x_new is a sparse product
+    knots = interpolate.make_interp_spline(x, np.zeros_like(x), k=3).t
+    collocation = interpolate.BSpline.design_matrix(x, knots, 3).tocoo()
+    evaluation = interpolate.BSpline.design_matrix(x_new, knots, 3, extrapolate)
+
+    lower, upper = int(np.max(collocation.row - collocation.col)), int(np.max(collocation.col - collocation.row))
+    banded = np.zeros((lower + upper + 1, len(x)))
+    banded[upper + collocation.row - collocation.col, collocation.col] = collocation.data
+    return (lower, upper), banded, evaluation.tocsr()
+
+
+def interpolateSpline(operator: tuple, y: np.ndarray) -> np.ndarray:
+    bands, banded, evaluation = operator
+    return evaluation @ linalg.solve_banded(bands, banded, np.asarray(y, dtype=np.float64), check_finite=False)
+
+
+def getFFTSize(rate: int, fft_size: int = 4096, reference_rate: int = 44100) -> int:
+    # Power of two closest to fft_size scaled by the sample rate, so bins stay about as wide as 4096 bins at 44.1 kHz
+    return 2 ** int(round(np.log2(fft_size * rate / reference_rate)))
+
+
+@lru_cache(maxsize=8)
+def getAnalysisPlan(rate: int = 44100, fft_size: int = 4096, lin_log_oversampling: int = 4) -> AnalysisPlan:
+    return AnalysisPlan(rate, fft_size, lin_log_oversampling)
+
+
+def averageFFT(loudest_pieces: np.ndarray, fft_size: int = 4096) -> np.ndarray:
+    # Same as the mean magnitude of a boxcar stft without overlap, padding or boundary extension, with "spectrum" scaling
+    frames = loudest_pieces.shape[-1] // fft_size
+    segments = loudest_pieces[..., :frames * fft_size].reshape(-1, frames, fft_size)
+
+    fft_average = np.abs(np.fft.rfft(segments, axis=-1)).mean((0, 1)) / fft_size
+
+    return fft_average
 
-    interpolator = interpolate.interp1d(grid_linear, matching_fft, "cubic")
-    matching_fft_log = interpolator(grid_logarithmic)
+
+def smoothExponentially(matching_fft: np.ndarray, lin_log_oversampling = 4, rate: int = 44100) -> np.ndarray:
+    plan = getAnalysisPlan(rate, 2 * (len(matching_fft) - 1), lin_log_oversampling)
+
+    matching_fft_log = interpolateSpline(plan.to_logarithmic, matching_fft)
 
     matching_fft_log_filtered = smoothLowess(matching_fft_log)
 
-    interpolator = interpolate.interp1d(grid_logarithmic, matching_fft_log_filtered, "cubic", fill_value="extrapolate")
-    
-    matching_fft_filtered = interpolator(grid_linear)
+    matching_fft_filtered = interpolateSpline(plan.to_linear, matching_fft_log_filtered)
 
     matching_fft_filtered[0] = 0
     matching_fft_filtered[1] = matching_fft[1]
@@ -103,27 +192,97 @@ def smoothExponentially(matching_fft: np.ndarray, lin_log_oversampling = 4) -> n
     return matching_fft_filtered
 
 
-def getFIR(targ_loudest_pieces: np.ndarray, ref_loudest_pieces: np.ndarray) -> np.ndarray:
+def getFIR(targ_loudest_pieces: np.ndarray, ref_average_fft: np.ndarray, rate: int = 44100) -> np.ndarray:
+    targ_average_fft = averageFFT(targ_loudest_pieces, getFFTSize(rate))
+    return getMatchingFIR(targ_average_fft, ref_average_fft, rate)
+
 
-    targ_average_fft = averageFFT(targ_loudest_pieces)
-    ref_average_fft = averageFFT(ref_loudest_pieces)
+def getMatchingFIR(targ_average_fft: np.ndarray, ref_average_fft: np.ndarray, rate: int = 44100) -> np.ndarray:
 
     matching_fft = ref_average_fft / targ_average_fft
 
-    matching_fft_filtered = smoothExponentially(matching_fft)
+    matching_fft_filtered = smoothExponentially(matching_fft, rate=rate)
 
     fir = np.fft.irfft(matching_fft_filtered)
-    fir = np.fft.ifftshift(fir) * signal.windows.hann(len(fir))
+    fir = np.fft.ifftshift(fir) * getAnalysisPlan(rate, len(fir)).fir_window
 
     return fir
 
 
 def convolve(targ_mid: np.ndarray, mid_fir: np.ndarray, targ_side: np.ndarray, side_fir: np.ndarray) -> (np.ndarray, np.ndarray):
-    result_mid = signal.fftconvolve(targ_mid, mid_fir, "same")
-    result_side = signal.fftconvolve(targ_side, side_fir, "same")
+    # FIRs are designed in float64, the convolution runs in the dtype of the audio and over all side channels at once
+    result_mid = signal.fftconvolve(targ_mid, mid_fir.astype(targ_mid.dtype, copy=False), "same")
+    result_side = signal.fftconvolve(targ_side, side_fir.astype(targ_side.dtype, copy=False)[:, None], "same", axes=0) if targ_side.shape[1] else targ_side
 
-    result = convertFromMidSideToLeftRight(result_mid, result_side)
+    result = convertFromMidSide(result_mid, result_side)
 
     return result, result_mid
 
 
+def convolveBlock(block: np.ndarray, fir: np.ndarray, history: np.ndarray) -> (np.ndarray, np.ndarray):
+    # Overlap-save: the last len(fir) - 1 samples of the previous block complete the convolution at the start of this one
+    extended = np.concatenate((history, block))
+    fir = fir.astype(block.dtype, copy=False).reshape(-1, *[1] * (block.ndim - 1))
+    return signal.fftconvolve(extended, fir, 'valid', axes=0), extended[len(extended) - len(fir) + 1:]
+
+
+@lru_cache(maxsize=1024)
+def getPeakingBiquad(rate: int, freq: float, gain_db: float, q: float) -> np.ndarray:
+    # RBJ audio EQ cookbook peaking filter as one second-order section
+    amplitude = 10**(gain_db/40)
+    w0 = 2 * np.pi * freq / rate
+    alpha = np.sin(w0) / (2 * q)
+
+    b = np.array([1 + alpha * amplitude, -2 * np.cos(w0), 1 - alpha * amplitude])
+    a = np.array([1 + alpha / amplitude, -2 * np.cos(w0), 1 - alpha / amplitude])
+
+    return np.hstack((b / a[0], a / a[0]))
+
+
+def designEqualizer(rate: int, bands: tuple, q: float = 5.0) -> np.ndarray:
+    sections = [getPeakingBiquad(rate, float(freq), float(gain_db), q) for freq, gain_db in bands if gain_db and 0 < float(freq) < rate / 2]
+    return np.array(sections).reshape(-1, 6)
+
+
+def getSmoothingCoefficient(rate: int, time_ms: float) -> float:
+    return float(np.exp(-1000 / (rate * time_ms))) if time_ms > 0 else 0.0
+
+
+def getGainReduction(level_db: np.ndarray, threshold: float, ratio: float, knee: float) -> np.ndarray:
+    over = level_db - threshold
+    slope = 1 - 1 / ratio
+
+    reduction = np.where(over > 0, slope * over, 0.0)
+    if knee > 0:
+        in_knee = np.abs(over) <= knee / 2
+        reduction = np.where(in_knee, slope * (over + knee / 2)**2 / (2 * knee), np.where(over > knee / 2, slope * over, 0.0))
+
+    return reduction
+
+
+def smoothGainReduction(reduction: np.ndarray, attack_coefficient: float, release_coefficient: float, state: tuple) -> (np.ndarray, tuple):
+    held_last, zi = state
+
+    # Release: held[n] = max(reduction[k] * c**(n-k)) for k <= n, which becomes a running maximum in the log domain
+    if release_coefficient > 0:
+        decay = -np.log(release_coefficient)
+        index = np.arange(reduction.shape[0])
+        with np.errstate(divide='ignore'):
+            log_held = np.maximum(np.maximum.accumulate(np.log(reduction) + index * decay), np.log(held_last) - decay)
+        held = np.exp(log_held - index * decay)
+    else:
+        held = reduction
+
+    # Attack: one-pole low-pass over the held envelope
+    smoothed, zi = signal.lfilter([1 - attack_coefficient], [1, -attack_coefficient], held, zi=zi)
+
+    return smoothed, (held[-1], zi)
+
+
+def compressBlock(block: np.ndarray, threshold: float, ratio: float, knee: float, makeup_gain: float, attack_coefficient: float, release_coefficient: float, state: tuple) -> (np.ndarray, tuple):
+    # Stereo-linked detection on the sample peak of all channels
+    level_db = 20 * np.log10(np.maximum(np.max(np.abs(block), axis=1), 1e-10))
+    reduction = getGainReduction(level_db, threshold, ratio, knee)
+    reduction, state = smoothGainReduction(reduction, attack_coefficient, release_coefficient, state)
+
+    return block * (makeup_gain * 10**(-reduction/20)).astype(block.dtype)[:, None], state
@@ -0,0 +1,265 @@
+from scipy import signal
+from math import gcd
+import soundfile as sf
+import numpy as np
+import itertools
+import tempfile
+import os
+
+from . import validator
+from . import audioIO
+from . import audioProcessorUtils as apu
+from .audioProcessor import AudioProcessorError, ReferenceAnalysis, normalization_headroom, checkReferenceRate
+
+
+# Streaming stages read and write files block by block, so memory is bounded by the block size instead of the track length
+
+
+def isStreamable(path: str, min_duration: float) -> bool:
+    if audioIO.getFormat(path) not in audioIO.soundfile_formats:
+        return False
+    return sf.info(path).duration >= min_duration
+
+
+def temporaryPath(path: str) -> str:
+    descriptor, temporary = tempfile.mkstemp(suffix='.wav', dir=os.path.dirname(path) or None)
+    os.close(descriptor)
+    return temporary
+
+
+def removeTemporary(path: str, keep: str):
+    if path != keep and os.path.exists(path):
+        os.remove(path)
+
+
+def openIntermediate(path: str, rate: int, channels: int) -> sf.SoundFile:
+    # RF64 lifts the 4 GB limit of WAV, so hours of float samples fit in one intermediate file
+    return sf.SoundFile(path, 'w', rate, channels, 'FLOAT', format='RF64')
+
+
+def readBlocks(source: sf.SoundFile, block_size: int):
+    # Blocks of uncompressed WAV files come from the mapped file: float32 blocks, as in the intermediate files, are
+    # read-only views, other sample types are scaled one block at a time
+    if (mapped := audioIO.mapAudio(source.name)) is not None:
+        samples, _ = mapped
+        return (audioIO.toFloat(samples[start:start + block_size]) for start in range(0, len(samples), block_size))
+    return source.blocks(block_size, dtype='float32', always_2d=True)
+
+
+def scaleStream(src: str, dst: str, block_size: int, gain=1.0) -> str:
+    with sf.SoundFile(src) as source, openIntermediate(dst, source.samplerate, source.channels) as output:
+        for block in readBlocks(source, block_size):
+            output.write(block * gain)
+    return dst
+
+
+def writeStream(src: str, dst: str, block_size: int, rate: int = None, resampling: str = 'quality') -> str:
+    if audioIO.getFormat(dst) not in audioIO.soundfile_formats:
+        raise AudioProcessorError("Format '%s' can not be written block by block" % audioIO.getFormat(dst))
+
+    with sf.SoundFile(src) as source, sf.SoundFile(dst, 'w', rate or source.samplerate, source.channels) as output:
+        for block in resampleBlocks(readBlocks(source, block_size), source.samplerate, rate or source.samplerate, resampling):
+            output.write(np.clip(block, -1.0, 1.0))
+    return dst
+
+
+def resampleStream(src: str, dst: str, block_size: int, rate: int, resampling: str = 'quality') -> str:
+    with sf.SoundFile(src) as source, openIntermediate(dst, rate, source.channels) as output:
+        for block in resampleBlocks(readBlocks(source, block_size), source.samplerate, rate, resampling):
+            output.write(block)
+    return dst
+
+
+def equalizeStream(src: str, dst: str, block_size: int, eq_dict: dict) -> str:
+    filtered = temporaryPath(dst)
+    try:
+        with sf.SoundFile(src) as source, openIntermediate(filtered, source.samplerate, source.channels) as output:
+            sos = apu.designEqualizer(source.samplerate, tuple(eq_dict.items()))
+            zi = np.zeros((len(sos), 2, source.channels))
+            peaks = np.zeros(source.channels)
+
+            for block in readBlocks(source, block_size):
+                if len(sos):
+                    block, zi = signal.sosfilt(sos, block, axis=0, zi=zi)
+                peaks = np.maximum(peaks, np.max(np.abs(block), axis=0))
+                output.write(block)
+
+        return scaleStream(filtered, dst, block_size, 1.0 / np.where(peaks > 0, peaks, 1.0))
+    finally:
+        removeTemporary(filtered, dst)
+
+
+def compressStream(src: str, dst: str, block_size: int, *, threshold = -20.0, ratio = 4.0, attack = 5.0, release = 50.0, knee = 0.0, makeup = 0.0) -> str:
+    with sf.SoundFile(src) as source, openIntermediate(dst, source.samplerate, source.channels) as output:
+        attack_coefficient = apu.getSmoothingCoefficient(source.samplerate, attack)
+        release_coefficient = apu.getSmoothingCoefficient(source.samplerate, release)
+        makeup_gain = 10**(makeup/20)
+        state = (0.0, np.zeros(1))
+
+        for block in readBlocks(source, block_size):
+            block, state = apu.compressBlock(block, threshold, ratio, knee, makeup_gain, attack_coefficient, release_coefficient, state)
+            output.write(block)
+    return dst
+
+
+def normalizeStream(src: str, dst: str, block_size: int, dBFS=None) -> str:
+    peak = 0.0
+    squares = 0.0
+    with sf.SoundFile(src) as source:
+        samples = source.frames * source.channels
+        for block in readBlocks(source, block_size):
+            peak = max(peak, float(np.max(np.abs(block))))
+            squares += float(np.sum(np.square(block, dtype=np.float64)))
+
+    if not dBFS:
+        gain = 10**(-normalization_headroom/20) / peak if peak else 1.0
+    else:
+        rms = np.sqrt(squares / samples) if samples else 0.0
+        delta_dBFS = dBFS - 20*np.log10(rms) if rms else 0.0
+        gain = 10**(delta_dBFS/20)
+
+    return scaleStream(src, dst, block_size, gain)
+
+
+def resampleBlocks(blocks, rate: int, target_rate: int, resampling: str = 'quality'):
+    if rate == target_rate:
+        yield from blocks
+        return
+
+    up, down = target_rate // gcd(rate, target_rate), rate // gcd(rate, target_rate)
+    resample = lambda chunk: validator.checkSampleRate(chunk, rate, target_rate, resampling)[0]
+
+    # Every chunk starts on a multiple of down and carries enough input on both sides to cover the resampling filter,
+    # so the chunks join into the output of validator.checkSampleRate over the whole signal
+    context = down * int(np.ceil((validator.getResamplingWidth(rate, target_rate, resampling) + 1) / down))
+    buffer = None
+    length = 0
+    produced = 0
+
+    for block in blocks:
+        buffer = np.concatenate((np.zeros((context, block.shape[1]), block.dtype) if buffer is None else buffer, block))
+        length += len(block)
+
+        chunk = (len(buffer) - 2 * context) // down * down
+        if chunk > 0:
+            yield resample(buffer[:chunk + 2 * context])[context * up // down:(context + chunk) * up // down]
+            produced += chunk * up // down
+            buffer = buffer[chunk:]
+
+    if buffer is None:
+        return
+
+    tail = np.concatenate((buffer, np.zeros((2 * context + down, buffer.shape[1]), buffer.dtype)))
+    chunk = (len(tail) - 2 * context) // down * down
+    remaining = int(length * float(target_rate) / float(rate)) - produced
+    yield resample(tail[:chunk + 2 * context])[context * up // down:context * up // down + remaining]
+
+
+def analyzePieces(path: str) -> (np.ndarray, np.ndarray, np.ndarray, int, int, int):
+    # Pieces are at most 15 seconds long, so one piece at a time is read instead of the whole track
+    with sf.SoundFile(path) as source:
+        fft_size = apu.getFFTSize(source.samplerate)
+        validator.checkFrames(source.frames, None, fft_size)
+        quantity, piece_size = apu.calculatePiecesParamsByLength(source.frames, source.samplerate)
+        RMSes = np.empty(quantity)
+        mid_ffts = np.empty((quantity, fft_size // 2 + 1))
+        side_ffts = np.empty((quantity, fft_size // 2 + 1 if source.channels > 1 else 0))
+
+        for index in range(quantity):
+            mid, side = apu.convertToMidSide(source.read(piece_size, dtype='float64', always_2d=True))
+
+            RMSes[index] = apu.getRMS(mid)
+            mid_ffts[index] = apu.averageFFT(mid[None, :], fft_size)
+            if source.channels > 1:
+                side_ffts[index] = apu.averageFFT(side.T, fft_size)
+
+    return RMSes, mid_ffts, side_ffts, quantity, piece_size, source.samplerate
+
+
+def getLoudest(RMSes: np.ndarray) -> (float, np.ndarray):
+    loudest_indexes = apu.getLoudestIndexes(RMSes, apu.getRMS(RMSes))
+    return apu.getRMS(RMSes[loudest_indexes]), loudest_indexes
+
+
+def analyzeReferenceStream(path: str, block_size: int, rate: int = None, resampling: str = 'quality') -> ReferenceAnalysis:
+    # As in analyzeReference, a reference of another rate is analysed after resampling it to the rate of the target
+    resampled = temporaryPath(path) if rate and rate != audioIO.getSampleRate(path) else path
+    try:
+        if resampled != path:
+            resampleStream(path, resampled, block_size, rate, resampling)
+        RMSes, mid_ffts, side_ffts, _, _, rate = analyzePieces(resampled)
+    finally:
+        removeTemporary(resampled, path)
+
+    # Every piece has the same number of STFT frames, so averaging the per-piece spectra equals averageFFT over all pieces
+    loudest_RMS, loudest_indexes = getLoudest(RMSes)
+    return ReferenceAnalysis(loudest_RMS, mid_ffts[loudest_indexes].mean(0), side_ffts[loudest_indexes].mean(0), rate)
+
+
+def convolveStream(src: str, dst: str, block_size: int, rms_coefficient: float, mid_fir: np.ndarray, side_fir: np.ndarray, quantity: int, piece_size: int) -> np.ndarray:
+    # Same output as the "same" mode fftconvolve of matchReference: the result starts delay samples into the full convolution
+    delay = (len(mid_fir) - 1) // 2
+    produced = 0
+    squares = np.zeros(quantity)
+
+    with sf.SoundFile(src) as source, openIntermediate(dst, source.samplerate, source.channels) as output:
+        frames = source.frames
+        mid_history = np.zeros(len(mid_fir) - 1)
+        side_history = np.zeros((len(side_fir) - 1, source.channels - 1))
+
+        for block in itertools.chain(readBlocks(source, block_size), [np.zeros((delay, source.channels), np.float32)]):
+            mid, side = apu.convertToMidSide(block)
+            mid, side = mid * rms_coefficient, side * rms_coefficient
+
+            result_mid, mid_history = apu.convolveBlock(mid, mid_fir, mid_history)
+            if source.channels > 1:
+                result_side, side_history = apu.convolveBlock(side, side_fir, side_history)
+            else:
+                result_side = side
+
+            start = max(delay - produced, 0)
+            end = min(len(block), delay + frames - produced)
+            position = produced + start - delay
+            produced += len(block)
+            if end <= start:
+                continue
+
+            result_mid, result_side = result_mid[start:end], result_side[start:end]
+            output.write(apu.convertFromMidSide(result_mid, result_side))
+
+            # Piece RMS of the clipped mid channel, accumulated as the blocks go by
+            indexes = np.arange(position, position + len(result_mid)) // piece_size
+            inside = indexes < quantity
+            squares += np.bincount(indexes[inside], weights=np.square(np.clip(result_mid[inside], -1.0, 1.0)), minlength=quantity)
+
+    return np.sqrt(squares / piece_size)
+
+
+def matchReferenceStream(src: str, dst: str, block_size: int, reference: ReferenceAnalysis) -> str:
+    convolved = temporaryPath(dst)
+    try:
+        RMSes, mid_ffts, side_ffts, quantity, piece_size, rate = analyzePieces(src)
+        checkReferenceRate(reference, rate)
+        targ_loudest_RMS, loudest_indexes = getLoudest(RMSes)
+        rms_coefficient = reference.loudest_RMS / targ_loudest_RMS
+
+        targ_mid_fft = mid_ffts[loudest_indexes].mean(0) * rms_coefficient
+        mid_fir = apu.getMatchingFIR(targ_mid_fft, reference.mid_fft, rate)
+        # As in matchReference, a mono reference gives the side of the target the correction of its mid
+        if side_ffts.shape[1] and len(reference.side_fft):
+            targ_side_fft = side_ffts[loudest_indexes].mean(0) * rms_coefficient
+            side_fir = apu.getMatchingFIR(targ_side_fft, reference.side_fft, rate)
+        else:
+            side_fir = mid_fir
+
+        result_RMSes = convolveStream(src, convolved, block_size, rms_coefficient, mid_fir, side_fir, quantity, piece_size)
+        result_loudest_RMS, _ = getLoudest(result_RMSes)
+
+        # Same correction steps as matchReference, whose result_mid keeps its level between the steps
+        gain = 1.0
+        for rms_step in range(1, 5):
+            gain *= reference.loudest_RMS / result_loudest_RMS
+
+        return scaleStream(convolved, dst, block_size, gain)
+    finally:
+        removeTemporary(convolved, dst)
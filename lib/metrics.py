@@ -0,0 +1,104 @@
+import collections
+import bisect
+
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def formatLabels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)] + ([extra] if extra else [])
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def formatValue(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: tuple = (), function=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # Metrics with a function are read when /metrics is scraped instead of being updated on the hot path
+        self.function = function
+        self.values = collections.defaultdict(float)
+
+    def samples(self) -> list:
+        if self.function is not None:
+            return [(self.name, '', self.function())]
+        return [(self.name, formatLabels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {formatValue(value)}' for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, labels: tuple = ()):
+        self.values[labels] += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = default_buckets):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self.counts = dict()
+        self.sums = collections.defaultdict(float)
+
+    def observe(self, value: float, labels: tuple = ()):
+        # Only the bucket the value falls into is counted here, the cumulative counts are built on scrape
+        if labels not in self.counts:
+            self.counts[labels] = [0] * (len(self.buckets) + 1)
+        self.counts[labels][bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self) -> list:
+        samples = []
+        for key, counts in sorted(self.counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', formatLabels(self.labels, key, f'le="{formatValue(bound)}"'), cumulative))
+            samples.append((f'{self.name}_sum', formatLabels(self.labels, key), self.sums[key]))
+            samples.append((f'{self.name}_count', formatLabels(self.labels, key), cumulative))
+        return samples
+
+
+class Metrics:
+    def __init__(self, prefix: str = 'som_'):
+        self.prefix = prefix
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, description: str, labels: tuple = (), function=None) -> Counter:
+        return self.register(Counter(name, description, labels, function))
+
+    def gauge(self, name: str, description: str, labels: tuple = (), function=None) -> Gauge:
+        return self.register(Gauge(name, description, labels, function))
+
+    def histogram(self, name: str, description: str, labels: tuple = (), buckets: tuple = default_buckets) -> Histogram:
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self) -> str:
+        # Prometheus text exposition format, version 0.0.4
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
@@ -0,0 +1,148 @@
+import collections
+import hashlib
+import logging
+import trio
+import os
+
+import numpy as np
+
+from .mastering import ReferenceAnalysis
+
+
+# Bump whenever the reference analysis changes, so stale entries are never reused
+analysis_version = 3
+
+
+def hashFile(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def loadAnalysis(path: str) -> ReferenceAnalysis:
+    with np.load(path) as data:
+        analysis = ReferenceAnalysis(float(data['loudest_RMS']), data['mid_fft'], data['side_fft'], int(data['rate']))
+    os.utime(path)
+    return analysis
+
+
+def saveAnalysis(path: str, analysis: ReferenceAnalysis):
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, loudest_RMS=analysis.loudest_RMS, mid_fft=analysis.mid_fft, side_fft=analysis.side_fft, rate=analysis.rate)
+    os.replace(tmp_path, path)
+
+
+class ReferenceCache:
+    def __init__(self, config: dict, logger=logging.getLogger('REFERENCE_CACHE')):
+        self.logger = logger
+        self.directory = config['CACHE']['directory']
+        self.memory_items = config['CACHE']['memory_items']
+        self.disk_max_bytes = config['CACHE']['disk_max_mb'] * 1024 * 1024
+        self.url_items = config['CACHE']['url_items']
+        self.memory = collections.OrderedDict()
+        self.urls = collections.OrderedDict()
+        self.pending = dict()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.evictFromDisk()
+
+
+    async def digest(self, path: str) -> str:
+        return await trio.to_thread.run_sync(hashFile, path)
+
+
+    def key(self, digest: str, rate: int, resampling: str) -> str:
+        # The analysis is made at the rate of the target, with the resampling mode when the reference has another rate.
+        # The rate of the reference is not known before it is downloaded, so the mode is always part of the key
+        return f'v{analysis_version}_{digest}_{rate}_{resampling}'
+
+
+    def findURL(self, validators: tuple) -> str:
+        # Content hash of a reference seen before with the same URL and HEAD validators, so it is not downloaded again
+        if (digest := self.urls.get(validators)) is not None:
+            self.urls.move_to_end(validators)
+        return digest
+
+
+    def rememberURL(self, validators: tuple, digest: str):
+        self.urls[validators] = digest
+        self.urls.move_to_end(validators)
+        while len(self.urls) > self.url_items:
+            self.urls.popitem(last=False)
+
+
+    def diskPath(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.npz')
+
+
+    def remember(self, key: str, analysis: ReferenceAnalysis):
+        self.memory[key] = analysis
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+
+    async def get(self, key: str) -> ReferenceAnalysis:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        try:
+            analysis = await trio.to_thread.run_sync(loadAnalysis, self.diskPath(key))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.logger.warning(f'Dropping unreadable cache entry {key}: "{str(e)}"')
+            return None
+
+        self.remember(key, analysis)
+        return analysis
+
+
+    async def put(self, key: str, analysis: ReferenceAnalysis):
+        self.remember(key, analysis)
+        try:
+            await trio.to_thread.run_sync(saveAnalysis, self.diskPath(key), analysis)
+            await trio.to_thread.run_sync(self.evictFromDisk)
+        except Exception as e:
+            self.logger.warning(f'Could not store cache entry {key}: "{str(e)}"')
+
+
+    def evictFromDisk(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz') and not entry.name.endswith('.tmp.npz'):
+                # Entries of an older analysis_version are never read again
+                if not entry.name.startswith(f'v{analysis_version}_'):
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.logger.debug(f'Evicted {path}')
+
+
+    async def getOrCompute(self, key: str, compute) -> ReferenceAnalysis:
+        # Concurrent requests for the same key wait for the first one instead of repeating the analysis
+        while key in self.pending:
+            await self.pending[key].wait()
+
+        self.pending[key] = trio.Event()
+        try:
+            if (analysis := await self.get(key)) is not None:
+                self.logger.debug(f'Cache hit for {key}')
+                return analysis
+
+            analysis = await compute()
+            await self.put(key, analysis)
+            return analysis
+        finally:
+            self.pending.pop(key).set()
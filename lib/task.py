@@ -1,63 +1,119 @@
 import logging
-import shutil
 import trio
-import asks
 import uuid
 import os
 import re
 
+from contextlib import nullcontext
 from functools import partial
-from .mastering import equalizeFile, compressFile, normalizeFile, byReference
+from .fileTransfer import ingestFile, placeFile
+from .mastering import equalize, compress, normalize, resample, matchReference, analyzeReferenceFile, readAudio, writeAudio, getFormat, getDuration, getSampleRate
+from .mastering import isStreamable, equalizeStream, compressStream, normalizeStream, matchReferenceStream, analyzeReferenceStream, writeStream
 
 class Task:
-    def __init__(self, subtasks: dict, config: dict, logger=None):
-        self.id = uuid.uuid4().hex
+    def __init__(self, subtasks: dict, config: dict, priority: int = None, client: str = '', batch=None, task_id: str = None, logger=None):
+        self.id = task_id or uuid.uuid4().hex
         self.subtasks = subtasks
         self.config = config
+        self.priority = priority if priority is not None else max(subtasks_priority.get(name, 0) for name in subtasks)
+        self.client = client
+        self.batch = batch
         self.logger = logger if logger else logging.getLogger(f'TASK_{self.id}')
         self.workspace = os.path.join(self.config['MAIN']['workspace'], f'{self.id}')
         self.location = self.config['MAIN']['location']
+        self.precision = self.config['MASTERING']['precision']
+        self.resampling = self.config['MASTERING']['resampling']
 
         self.status = 'Created'
         self.comment = 'Success'
         self.target_path = ''
         self.reference_path = ''
+        self.reference_url = None
+        self.reference_digest = None
         self.last_path = ''
+        self.audio = None
+        self.rate = None
+        self.download_rate = 0.0
+        self.shared_audio_released = False
+        self.streaming = False
+        self.stream_path = ''
+        self.completed = []
+        self.duration = None
+        self.cpu_time = 0.0
+        self.queued_at = 0.0
         self.task_manager = None
 
-        os.makedirs(self.workspace)
+        os.makedirs(self.workspace, exist_ok=True)
         self.logger.debug('Created directory')
         self.logger.info('Schedule: '+ (', '.join(self.subtasks.keys())))
 
 
+    @classmethod
+    def fromRecord(cls, record: dict, config: dict):
+        task = cls(record['subtasks'], config, priority=record['priority'], client=record['client'], task_id=record['id'])
+        task.comment = record['comment']
+
+        # Files in the workspace survive a restart, decoded audio does not: in-memory stages run again from the
+        # downloaded target, streaming stages continue from the last intermediate file
+        # The reference is not downloaded when its analysis was cached, it is fetched again if the reference stage needs it
+        paths = [record['target_path']] + ([record['reference_path']] if record['reference_path'] else [])
+        if 'download' in record['completed'] and all(path and os.path.exists(path) for path in paths):
+            task.target_path = record['target_path']
+            task.reference_path = record['reference_path']
+            task.streaming = bool(record['streaming'])
+            task.stream_path = task.target_path
+            task.completed = ['download']
+
+            if task.streaming and os.path.exists(record['stream_path']):
+                task.stream_path = record['stream_path']
+                task.completed = record['completed']
+
+        task.status = subtasks_info[task.completed[-1]][0] if task.completed else 'Created'
+        task.logger.info(f'Restored, completed subtasks: {", ".join(task.completed) or "none"}')
+        return task
+
+
     async def copyFileInWorkspace(self, path: str, prefix: str = '') -> (bool, str):
         try:
             ext = path.split('.')[-1]
             dst = os.path.join(self.workspace, f'{prefix}_{self.id}' + '.' + ext)
-            shutil.copy2(path, dst)
+            method = await trio.to_thread.run_sync(ingestFile, path, dst, self.config['INGEST']['methods'], self.config['INGEST']['chunk_size'])
+            self.logger.info(f'Ingested {path} ({method})')
             return True, str(dst)
         except Exception as e:
             self.logger.info(f'Copy error: "{str(e)}"')
             return False, ''
-        
+
 
     async def downloadFileInWorkspace(self, url: str, prefix: str) -> (bool, str):
-        try:
-            ext = ext = url.split('.')[-1]
-            resp = await asks.get(url)
-            
-            if resp.status_code != 200:
-                return False, ''
-            
-            dst = os.path.join(self.workspace, f'{prefix}_{self.id}' + '.' + ext)
-            with open(dst, 'wb') as f:
-                f.write(resp.content)
-            return True, dst
-        
-        except Exception as e:
-            self.logger.info(f'Download error: "{str(e)}"')
+        ext = url.split('.')[-1]
+        dst = os.path.join(self.workspace, f'{prefix}_{self.id}' + '.' + ext)
+
+        started = trio.current_time()
+        ok, comment, received = await self.task_manager.downloader.download(url, dst)
+        elapsed = max(trio.current_time() - started, 1e-6)
+
+        if not ok:
+            self.logger.info(f'Download error: "{comment}"')
             return False, ''
 
+        self.download_rate = received / elapsed
+        self.task_manager.downloaded_bytes.inc(received)
+        self.logger.info(f'Downloaded {received} bytes in {elapsed:.2f} s ({self.download_rate / 1024**2:.2f} MB/s)')
+        return True, dst
+
+
+    async def fetchFile(self, location: str, prefix: str) -> (bool, str):
+        if re.match(r'http(s)?:\/\/.*', str(location)):
+            return await self.downloadFileInWorkspace(location, prefix)
+        return await self.copyFileInWorkspace(location, prefix)
+
+
+    async def fetchSharedFile(self, location: str, prefix: str) -> (bool, str):
+        if self.batch is None:
+            return await self.fetchFile(location, prefix)
+        return await self.batch.share((prefix, location), partial(self.fetchFile, location, prefix))
+
 
     async def runDownloadSubtask(self, *args) -> (bool, str):
         self.logger.debug('Inside the "runDownloadSubtask" function')
@@ -65,39 +121,114 @@ class Task:
         targ = self.subtasks['download'].get('target')
         ref = self.subtasks['download'].get('reference')
 
-        targ_is_url = re.match(r'http(s)?:\/\/.*', str(targ))
-        ref_is_url = re.match(r'http(s)?:\/\/.*', str(ref))
-
         if targ:
-            targ_ok, comment = await self.downloadFileInWorkspace(targ, 'targ') if targ_is_url else await self.copyFileInWorkspace(targ, 'targ')
+            targ_ok, comment = await self.fetchSharedFile(targ, 'targ')
 
             if targ_ok:
                 self.target_path = comment
+                self.streaming = await self.isLongInput(self.target_path)
+                self.stream_path = self.target_path
+                if self.streaming:
+                    self.duration = await trio.to_thread.run_sync(getDuration, self.target_path)
             else:
                 return False, 'Error while downloading or copying target file'
         else:
             return False, 'Target file location is a mandatory parameter'
 
         if ref:
-            ref_ok, comment = await self.downloadFileInWorkspace(ref, 'ref') if ref_is_url else await self.copyFileInWorkspace(ref, 'ref')
-
-            if ref_ok:
-                self.reference_path = comment
-            else:
+            if await self.findCachedReference(ref):
+                self.logger.info('Reference is known from its HEAD validators, it is not downloaded')
+            elif not await self.fetchReference():
                 return False, 'Error while downloading or copying reference file'
         
         return True, self.target_path
+
+
+    async def findCachedReference(self, location: str) -> bool:
+        # A HEAD request is enough to recognise a reference downloaded before, the content hash is the fallback
+        if not re.match(r'http(s)?:\/\/.*', str(location)):
+            return False
+        self.reference_url = await self.task_manager.downloader.probe(location)
+        if self.reference_url is not None:
+            self.reference_digest = self.task_manager.reference_cache.findURL(self.reference_url)
+        return self.reference_digest is not None
+
+
+    async def fetchReference(self) -> bool:
+        ref_ok, comment = await self.fetchSharedFile(self.subtasks['download']['reference'], 'ref')
+        if ref_ok:
+            self.reference_path = comment
+        return ref_ok
         
 
+    async def isLongInput(self, path: str) -> bool:
+        try:
+            long_input = await trio.to_thread.run_sync(isStreamable, path, self.config['STREAMING']['min_duration'])
+        except Exception as e:
+            self.logger.debug(f'Could not read the duration of {path}: "{str(e)}"')
+            return False
+
+        if long_input:
+            self.logger.info(f'{os.path.basename(path)} is long, it will be processed block by block')
+        return long_input
+
+
+    async def runStreamingStage(self, func, suffix: str, *args, **kwargs):
+        # Every stage reads the previous intermediate file and writes the next one, which replaces it
+        dst = os.path.join(self.workspace, f'targ_{self.id}_{suffix}.wav')
+        await self.runDSP(func, self.stream_path, dst, self.config['STREAMING']['block_size'], *args, **kwargs)
+
+        if self.stream_path != self.target_path:
+            os.remove(self.stream_path)
+        self.stream_path = dst
+
+
+    async def runDSP(self, func, *args, **kwargs):
+        result, cpu_time = await self.task_manager.dsp_executor.runTimed(func, *args, **kwargs)
+        self.cpu_time += cpu_time
+        return result
+
+
+    async def decodeSharedTarget(self) -> (object, int):
+        audio, rate = await trio.to_thread.run_sync(readAudio, self.target_path, self.precision)
+        # Every variant of the batch reads this array, stages must never modify it in place
+        audio.flags.writeable = False
+        return audio, rate
+
+
+    def sharedAudioKey(self) -> tuple:
+        return ('audio', self.subtasks['download']['target'])
+
+
+    def releaseSharedAudio(self):
+        if self.batch is not None and not self.shared_audio_released:
+            self.shared_audio_released = True
+            self.batch.release(self.sharedAudioKey())
+
+
+    async def loadAudio(self):
+        if self.audio is None:
+            if self.batch is None:
+                self.audio, self.rate = await trio.to_thread.run_sync(readAudio, self.target_path, self.precision)
+            else:
+                self.audio, self.rate = await self.batch.share(self.sharedAudioKey(), self.decodeSharedTarget)
+                self.releaseSharedAudio()
+            self.duration = self.audio.shape[0] / self.rate
+            self.logger.debug(f'Decoded target: {self.audio.shape[0]} frames, {self.rate} Hz')
+
+
     async def runEqualizeSubtask(self, *args) -> (bool, str):
         self.logger.debug('Inside the "runEqualizeSubtask" function')
 
-        path = args[0]
         try:
             equalization_params = self.subtasks['equalize']
-            equalized_file_path = await trio.to_thread.run_sync(equalizeFile, path, equalization_params)
-            self.logger.debug(f'\tequalized_file_path: {equalized_file_path}')
-            return True, equalized_file_path
+            if self.streaming:
+                await self.runStreamingStage(equalizeStream, 'eq', equalization_params)
+                return True, 'Equalized'
+
+            await self.loadAudio()
+            self.audio, self.rate = await self.runDSP(equalize, self.audio, self.rate, equalization_params)
+            return True, 'Equalized'
         except Exception as e:
             return False, f'Error in equalization: {str(e)}'
         
@@ -105,13 +236,15 @@ class Task:
     async def runCompressionSubtask(self, *args) -> (bool, str):
         self.logger.debug('Inside the "runCompressionSubtask" function')
 
-        path = args[0]
         try:
             compression_params = self.subtasks['compress']
-            compress_partial = partial(compressFile, path, **compression_params)
-            compressed_file_path = await trio.to_thread.run_sync(compress_partial)
-            self.logger.debug(f'\tcompressed_file_path: {compressed_file_path}')
-            return True, compressed_file_path
+            if self.streaming:
+                await self.runStreamingStage(compressStream, 'comp', **compression_params)
+                return True, 'Compressed'
+
+            await self.loadAudio()
+            self.audio, self.rate = await self.runDSP(compress, self.audio, self.rate, **compression_params)
+            return True, 'Compressed'
         except Exception as e:
             return False, f'Error in compression: {str(e)}'
 
@@ -119,14 +252,15 @@ class Task:
     async def runNormalizationSubtask(self, *args) -> (bool, str):
         self.logger.debug('Inside the "runNormalizationSubtask" function')
 
-        path = args[0]
         try:
             normalization_params = self.subtasks['normalize']
-            normalized_partial = partial(normalizeFile, path, **normalization_params)
-            normalized_file_path = await trio.to_thread.run_sync(normalized_partial)
+            if self.streaming:
+                await self.runStreamingStage(normalizeStream, 'norm', **normalization_params)
+                return True, 'Normalized'
 
-            self.logger.debug(f'\tnormalized_file_path: {normalized_file_path}')
-            return True, normalized_file_path
+            await self.loadAudio()
+            self.audio, self.rate = await self.runDSP(normalize, self.audio, self.rate, **normalization_params)
+            return True, 'Normalized'
         except Exception as e:
             return False, f'Error in normalization: {str(e)}'
 
@@ -134,71 +268,182 @@ class Task:
     async def runReferenceSubtask(self, *args) -> (bool, str):
         self.logger.debug('Inside the "runReferenceSubtask" function')
 
-        target_path = args[0]
-        reference_path = self.reference_path
-
         try:
-            referenced_partial = partial(byReference, target_path, reference_path)
-            referenced_file_path = await trio.to_thread.run_sync(referenced_partial)
+            reference_cache = self.task_manager.reference_cache
 
-            self.logger.debug(f'\treferenced_file_path: {referenced_file_path}')
-            return True, referenced_file_path
+            # The reference is analysed at the rate of the target, resampled if it has another one
+            if self.streaming:
+                rate = await trio.to_thread.run_sync(getSampleRate, self.stream_path)
+            else:
+                await self.loadAudio()
+                rate = self.rate
+
+            if self.reference_digest is None:
+                if not self.reference_path and not await self.fetchReference():
+                    return False, 'Error while downloading or copying reference file'
+                self.reference_digest = await reference_cache.digest(self.reference_path)
+                if self.reference_url is not None:
+                    reference_cache.rememberURL(self.reference_url, self.reference_digest)
+
+            async def analyze():
+                # A reference recognised by its URL is downloaded only when no analysis at this rate is cached
+                if not self.reference_path and not await self.fetchReference():
+                    raise Exception('Error while downloading or copying reference file')
+                if await self.isLongInput(self.reference_path):
+                    return await self.runDSP(analyzeReferenceStream, self.reference_path, self.config['STREAMING']['block_size'], rate, self.resampling)
+                return await self.runDSP(analyzeReferenceFile, self.reference_path, self.precision, rate, self.resampling)
+
+            key = reference_cache.key(self.reference_digest, rate, self.resampling)
+            reference = await reference_cache.getOrCompute(key, analyze)
+
+            if self.streaming:
+                await self.runStreamingStage(matchReferenceStream, 'ref', reference)
+                return True, 'Referenced'
+
+            self.audio, self.rate = await self.runDSP(matchReference, self.audio, self.rate, reference)
+            return True, 'Referenced'
 
         except Exception as e:
             return False, f'Error in referencing: {str(e)}'
 
 
     async def runFinalSubtask(self, *args) -> (bool, str):
-        path = args[0]
-        self.logger.info(f'Inside the "runFinalSubtask" with "{path}" path')
-        if self.location == 'remote':
-            with open(path, 'rb') as f:
-                data = f.read()
+        output_format = self.subtasks['final'].get('format') or getFormat(self.target_path)
+        output_rate = self.subtasks['final'].get('rate')
 
-        elif self.location == 'local':
-            data = path
+        unchanged = self.audio is None and self.stream_path in ('', self.target_path) and output_format == getFormat(self.target_path)
+        if unchanged and output_rate:
+            unchanged = output_rate == await trio.to_thread.run_sync(getSampleRate, self.target_path)
 
+        if unchanged:
+            path = self.target_path
         else:
-            return False, 'Unknown "location" value'
+            # Variants of a batch share one target file, so the result always goes to this task's own workspace
+            path = os.path.join(self.workspace, f'targ_{self.id}_mastered.{output_format}')
+            try:
+                async with self.task_manager.limiters['cpu']:
+                    if self.streaming:
+                        await trio.to_thread.run_sync(writeStream, self.stream_path, path, self.config['STREAMING']['block_size'], output_rate, self.resampling)
+                        if self.stream_path != self.target_path:
+                            os.remove(self.stream_path)
+                    else:
+                        await self.loadAudio()
+                        if output_rate:
+                            self.audio, self.rate = await self.runDSP(resample, self.audio, self.rate, output_rate, self.resampling)
+                        await trio.to_thread.run_sync(writeAudio, path, self.audio, self.rate)
+            except Exception as e:
+                return False, f'Error while encoding result: {str(e)}'
+            self.audio = None
+
+        self.last_path = path
+        self.logger.info(f'Inside the "runFinalSubtask" with "{path}" path')
+        callback = self.subtasks['final']['callback']
+        callbacks = self.task_manager.callbacks
 
         try:
-            resp = None
-            
-            resp = await asks.post(self.subtasks['final']['callback'], data=data)
+            async with self.task_manager.limiters['io']:
+                if self.location == 'remote':
+                    ok, comment, sent = await callbacks.deliver(self.id, callback, path=path)
 
-            if resp and resp.status_code != 200:
-                return False, 'Unsuccessfull callback HTTP status code'
+                elif self.location == 'local':
+                    path = await self.deliverLocally(path)
+                    ok, comment, sent = await callbacks.deliver(self.id, callback, text=path)
+
+                else:
+                    return False, 'Unknown "location" value'
         except Exception as e:
             return False, f'Unsuccessfull callback request with error: {str(e)}'
-        
+
+        if not ok:
+            return False, comment
+        self.task_manager.uploaded_bytes.inc(sent)
         return True, 'Success'
-                
+
+
+    async def deliverLocally(self, path: str) -> str:
+        output_directory = self.config['DELIVERY']['output_directory']
+        if not output_directory:
+            return path
+
+        dst = os.path.join(output_directory, f'{self.id}_mastered.{getFormat(path)}')
+        # The unprocessed target of a batch is shared by its variants, so it is never moved away from them
+        mode = 'link' if self.batch is not None and path == self.target_path else self.config['DELIVERY']['mode']
+        await trio.to_thread.run_sync(placeFile, path, dst, mode)
+        self.last_path = dst
+        self.logger.info(f'Result is placed at "{dst}" ({mode})')
+        return dst
+
+
+    async def reportProgress(self, subtask_name: str, started: float):
+        # DSP stages run in worker processes, so progress is estimated from the speed of earlier runs of the stage
+        events = self.task_manager.events
+        while True:
+            await trio.sleep(events.progress_interval)
+            if events.hasSubscribers(self.id):
+                elapsed = trio.current_time() - started
+                percent = self.task_manager.estimateProgress(subtask_name, elapsed, self.duration)
+                events.publish(self.id, 'progress', {'stage': subtask_name, 'elapsed': round(elapsed, 3), 'percent': percent})
+
+
+    def publishStatus(self, subtask_name: str, wall_time: float):
+        self.task_manager.events.publish(self.id, 'status', {
+            'status': self.status,
+            'comment': self.comment,
+            'stage': subtask_name,
+            'wall_time': round(wall_time, 3),
+            'cpu_time': round(self.cpu_time, 3),
+            'completed': len(self.completed),
+            'total': len(self.subtasks)
+        })
+
 
     async def runSubtask(self, subtask_name, *args) -> (bool, str):
-        end_status, handler = subtasks_info.get(subtask_name, (None, None))
+        end_status, handler, stage_kind = subtasks_info.get(subtask_name, (None, None, None))
         
         ok = False
         comment = 'Not supported subtask name'
+        wall_time = 0.0
 
         if handler:
-            self.logger.info(f'Start "{subtask_name}" subtask')
-            ok, comment = await handler(self, *args)
+            # Stages without a limiter kind take the limiters themselves around each of their steps
+            limiter = self.task_manager.limiters[stage_kind] if stage_kind else nullcontext()
+            async with limiter:
+                self.logger.info(f'Start "{subtask_name}" subtask')
+                started = trio.current_time()
+                self.cpu_time = 0.0
+                self.task_manager.events.publish(self.id, 'stage', {'stage': subtask_name, 'status': self.status})
+                async with trio.open_nursery() as nursery:
+                    if stage_kind == 'cpu':
+                        nursery.start_soon(self.reportProgress, subtask_name, started)
+                    ok, comment = await handler(self, *args)
+                    nursery.cancel_scope.cancel()
+                wall_time = trio.current_time() - started
+                audio_seconds = self.duration if ok and stage_kind == 'cpu' else 0.0
+                self.task_manager.observeStage(subtask_name, wall_time, self.cpu_time, audio_seconds)
+            await self.task_manager.workspace.measure(self.id)
             self.logger.debug(f'Out of handler function with ok: {ok} and comment: {comment}')
 
         if not ok:
             self.status = 'Error'
             self.comment = comment
             self.logger.debug(f'Changed status to "Error", with comment: {comment}')
+            await self.task_manager.store.save(self)
+            self.publishStatus(subtask_name, wall_time)
             return False, comment
 
         self.status = end_status
+        self.completed.append(subtask_name)
         self.logger.info(f'Changed status to "{end_status}"')
+        await self.task_manager.store.save(self)
+        self.publishStatus(subtask_name, wall_time)
         return True, comment
 
 
     async def run(self):
         comment = ''
         for subtask_name in self.subtasks.keys():
+            if subtask_name in self.completed:
+                continue
             ok, comment = await self.runSubtask(subtask_name, comment)
             if not ok:
                 self.logger.warning(f'Bad subtask result. Comment: {comment}')
@@ -206,15 +451,28 @@ class Task:
         else:
             self.logger.info(f'All subtasks completed successfully')
         
+        self.releaseSharedAudio()
         self.task_manager.deleteTask(self.id)
 
 
-# Rows should look like '<subtask_name>': ('<end_status>', <handler>)
+# Rows should look like '<subtask_name>': ('<end_status>', <handler>, '<limiter>'), where limiter is 'io', 'cpu' or None
+# None is for stages that mix both kinds of work: the final stage encodes under 'cpu' and delivers under 'io'
 subtasks_info = {
-    'download': ('Downloaded', Task.runDownloadSubtask),
-    'equalize': ('Equalized', Task.runEqualizeSubtask),
-    'compress': ('Compressed', Task.runCompressionSubtask),
-    'normalize': ('Normalized', Task.runNormalizationSubtask),
-    'reference': ('Referenced', Task.runReferenceSubtask),
-    'final': ('Done', Task.runFinalSubtask)
+    'download': ('Downloaded', Task.runDownloadSubtask, 'io'),
+    'equalize': ('Equalized', Task.runEqualizeSubtask, 'cpu'),
+    'compress': ('Compressed', Task.runCompressionSubtask, 'cpu'),
+    'normalize': ('Normalized', Task.runNormalizationSubtask, 'cpu'),
+    'reference': ('Referenced', Task.runReferenceSubtask, 'cpu'),
+    'final': ('Done', Task.runFinalSubtask, None)
+}
+
+# Default queue priority of a task is the highest value among its subtasks, lower values are served first
+subtasks_priority = {
+    'normalize': 0,
+    'equalize': 1,
+    'compress': 1,
+    'reference': 2
 }
+
+# A priority given in the request must lie in this range, so a client can not put its tasks ahead of everything else
+priority_range = range(0, 10)
@@ -1,47 +1,234 @@
+import itertools
 import logging
+import heapq
 import trio
 import os
 
 from .task import Task
+from .batch import summarizeBatch
 
 
 class Queue:
-    def __init__(self):
-        self._items = []
-        self._event = trio.Event()
+    # Heap of (priority, client round, arrival) keys: a lower priority value is served first and,
+    # inside one priority, clients take turns instead of one busy client starving the others
+    def __init__(self, max_size: int = 0):
+        self._heap = []
+        self._lot = trio.lowlevel.ParkingLot()
+        self._arrivals = itertools.count()
+        self._round = 0
+        self._client_rounds = {}
+        self.max_size = max_size
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def full(self) -> bool:
+        return not self.hasRoom(1)
+
+    def hasRoom(self, count: int) -> bool:
+        return not self.max_size or len(self._heap) + count <= self.max_size
+
+    def _push(self, item):
+        client = item.client
+        item_round = max(self._round, self._client_rounds.get(client, 0)) + 1
+        self._client_rounds[client] = item_round
+        heapq.heappush(self._heap, (item.priority, item_round, next(self._arrivals), client, item))
+        self._lot.unpark()
+
+    def put_nowait(self, item):
+        if self.full():
+            raise trio.WouldBlock
+        self._push(item)
 
     async def put(self, item):
-        self._items.append(item)
-        self._event.set()
+        self._push(item)
         return
 
     async def get(self):
-        await self._event.wait()
-        item = self._items.pop(0)
-        if not self._items:
-            self._event = trio.Event()
+        while not self._heap:
+            await self._lot.park()
+        _, item_round, _, client, item = heapq.heappop(self._heap)
+        self._round = max(self._round, item_round)
+        if self._client_rounds.get(client) == item_round:
+            del self._client_rounds[client]
         return item
 
 
 class TaskManager:
-    def __init__(self, logger=logging.getLogger('TASK_MANAGER')):
+    def __init__(self, config, dsp_executor, downloader, callbacks, reference_cache, store, workspace, events, metrics, logger=logging.getLogger('TASK_MANAGER')):
+        self.config = config
         self.tasks = dict()
+        self.batches = dict()
         self.logger = logger
-        self.new_tasks_queue = Queue()
+        self.dsp_executor = dsp_executor
+        self.downloader = downloader
+        self.callbacks = callbacks
+        self.reference_cache = reference_cache
+        self.store = store
+        self.workspace = workspace
+        self.events = events
+        self.stage_speed = dict()
+        self.metrics = metrics
+        self.retry_after = config['SCHEDULER']['retry_after']
+        self.new_tasks_queue = Queue(config['SCHEDULER']['max_pending'])
+        self.running_tasks = trio.Semaphore(config['SCHEDULER']['max_running'])
+        self.limiters = {
+            'io': trio.CapacityLimiter(config['SCHEDULER']['io_concurrency']),
+            'cpu': trio.CapacityLimiter(config['SCHEDULER']['cpu_concurrency'] or dsp_executor.workers)
+        }
 
+        max_running = config['SCHEDULER']['max_running']
+        self.stage_seconds = metrics.histogram('stage_duration_seconds', 'Wall time of task stages', ('stage', ))
+        self.stage_cpu_seconds = metrics.histogram('stage_cpu_seconds', 'CPU time DSP workers spent on a task stage', ('stage', ))
+        self.audio_seconds = metrics.counter('audio_seconds_total', 'Seconds of audio processed by DSP stages', ('stage', ))
+        self.downloaded_bytes = metrics.counter('downloaded_bytes_total', 'Bytes of target and reference files downloaded')
+        self.uploaded_bytes = metrics.counter('uploaded_bytes_total', 'Bytes sent to callback URLs')
+        self.finished_tasks = metrics.counter('tasks_total', 'Finished tasks by final status', ('status', ))
+        self.queue_wait_seconds = metrics.histogram('queue_wait_seconds', 'Time tasks spend in the pending queue')
+        metrics.gauge('queue_depth', 'Tasks waiting in the pending queue', function=lambda: len(self.new_tasks_queue))
+        metrics.gauge('running_tasks', 'Tasks being processed', function=lambda: max_running - self.running_tasks.value)
+        metrics.gauge('dsp_workers', 'Size of the DSP worker pool', function=lambda: dsp_executor.workers)
+        metrics.gauge('dsp_active_jobs', 'DSP jobs running or waiting for a worker', function=lambda: dsp_executor.active)
+        metrics.gauge('workspace_bytes', 'Disk space used by task workspaces', function=workspace.used)
+        metrics.gauge('workspace_quota_bytes', 'Workspace disk quota, 0 means no quota', function=lambda: workspace.quota)
+        metrics.gauge('callbacks_in_flight', 'Callback requests being sent', function=lambda: callbacks.in_flight.borrowed_tokens)
+        metrics.gauge('callback_idle_connections', 'Pooled keep-alive connections to callback receivers', function=callbacks.idleConnections)
+        metrics.gauge('callback_outbox', 'Callbacks waiting in the outbox, including the ones being sent', function=store.countCallbacks)
+        metrics.counter('callbacks_dropped_total', 'Callbacks given up after outbox_max_age or a permanent error on redelivery', function=lambda: callbacks.dropped)
+        metrics.gauge('event_subscribers', 'Open /events streams', function=events.subscribers)
+        metrics.counter('dsp_busy_seconds_total', 'Wall time of DSP jobs, its rate divided by dsp_workers is the worker utilization', function=lambda: dsp_executor.busy_seconds)
 
-    async def processTasks(self):
-        self.logger.info('Task manager is running')
-        while True:
-            task = await self.new_tasks_queue.get()
+
+    async def addTasks(self, tasks: list):
+        # All tasks are queued before their records are written, the handlers checked for room and nothing else may take it meanwhile
+        for task in tasks:
+            task.task_manager = self
+            task.queued_at = trio.current_time()
             self.tasks[task.id] = task
+            self.new_tasks_queue.put_nowait(task)
+        for task in tasks:
+            await self.store.save(task)
+
+
+    async def restoreTasks(self):
+        # Restored tasks were accepted before the restart, so they are queued even above max_pending
+        for record in await self.store.getUnfinished():
+            try:
+                task = Task.fromRecord(record, self.config)
+            except Exception as e:
+                self.logger.error(f'Could not restore task {record["id"]}: {str(e)}')
+                continue
             task.task_manager = self
-            trio.lowlevel.spawn_system_task(task.run)
+            task.queued_at = trio.current_time()
+            self.tasks[task.id] = task
+            await self.store.save(task)
+            await self.new_tasks_queue.put(task)
+            self.logger.info(f'Task {task.id} is queued again after restart')
+
+
+    async def expireTasks(self):
+        while True:
+            if deleted := await self.store.deleteExpired():
+                self.logger.debug(f'Deleted {deleted} expired task records')
+            await trio.sleep(self.store.sweep_interval)
+
+
+    async def sweepWorkspaces(self):
+        while True:
+            if removed := await self.workspace.sweep(await self.protectedWorkspaces()):
+                self.logger.debug(f'Deleted {removed} expired task workspaces')
+            await trio.sleep(self.workspace.sweep_interval)
 
 
-    def getTaskStatus(self, task_id: str) -> str:
+    async def protectedWorkspaces(self) -> set:
+        # Variants of a batch read the target downloaded into the workspace of whichever variant fetched it
+        # and results of callbacks waiting in the outbox are needed until they are redelivered
+        names = set(self.tasks)
+        for task in self.tasks.values():
+            names.update(os.path.basename(os.path.dirname(path)) for path in (task.target_path, task.reference_path) if path)
+        names.update(await self.store.getCallbackTasks())
+        return names
+
+
+    async def cleanWorkspace(self, task: Task):
+        # Only results handed to a local callback outlive their tasks, the sweeper deletes them after the retention period.
+        # Files a batch shares stay until its last variant finishes, which then cleans the workspaces of all variants
+        finished_tasks = task.batch.tasks if task.batch is not None and task.batch.finished() else [task]
+        keep = {path for other in self.tasks.values() for path in (other.target_path, other.reference_path) if path}
+        keep.update(await self.store.getCallbackPaths([finished_task.id for finished_task in finished_tasks]))
+        for finished_task in finished_tasks:
+            results = {finished_task.last_path} if finished_task.location == 'local' and finished_task.status == 'Done' else set()
+            await self.workspace.removeFiles(finished_task.id, keep | results)
+
+
+    async def processTasks(self):
+        self.logger.info('Task manager is running')
+        await self.restoreTasks()
+        async with trio.open_nursery() as nursery:
+            while True:
+                await self.running_tasks.acquire()
+                task = await self.new_tasks_queue.get()
+                self.queue_wait_seconds.observe(trio.current_time() - task.queued_at)
+                self.tasks[task.id] = task
+                task.task_manager = self
+                nursery.start_soon(self.runTask, task)
+
+
+    async def runTask(self, task: Task):
+        try:
+            await task.run()
+        except Exception as e:
+            self.logger.error(f'Task {task.id} failed with unexpected error: {str(e)}')
+            task.status = 'Error'
+            task.comment = str(e)
+            try:
+                await self.store.save(task)
+            except Exception as store_error:
+                # A failing store must not skip the event, the removal of the task and the release of its slot
+                self.logger.error(f'Failed to save the error status of task {task.id}: {str(store_error)}')
+            self.events.publish(task.id, 'status', {'status': task.status, 'comment': task.comment})
+            self.deleteTask(task.id)
+        finally:
+            if task.status in ('Done', 'Error'):
+                with trio.CancelScope(shield=True):
+                    await self.cleanWorkspace(task)
+            self.finished_tasks.inc(labels=(task.status, ))
+            self.running_tasks.release()
+
+
+    def observeStage(self, stage: str, wall_time: float, cpu_time: float, audio_seconds: float):
+        self.stage_seconds.observe(wall_time, (stage, ))
+        if cpu_time:
+            self.stage_cpu_seconds.observe(cpu_time, (stage, ))
+        if audio_seconds:
+            self.audio_seconds.inc(audio_seconds, (stage, ))
+            # Moving average of wall seconds per second of audio, the base of the progress estimates of later runs
+            speed = wall_time / audio_seconds
+            self.stage_speed[stage] = 0.8 * self.stage_speed[stage] + 0.2 * speed if stage in self.stage_speed else speed
+
+
+    def estimateProgress(self, stage: str, elapsed: float, audio_seconds: float) -> float:
+        if stage not in self.stage_speed or not audio_seconds:
+            return None
+        return round(min(99.0, 100 * elapsed / (self.stage_speed[stage] * audio_seconds)), 1)
+
+
+    async def getTaskStatus(self, task_id: str) -> str:
         if task_id in self.tasks:
             return self.tasks[task_id].status
+        # Finished tasks are answered from the store until their records expire
+        return await self.store.getStatus(task_id)
+
+
+    def addBatch(self, batch):
+        self.batches[batch.id] = batch
+
+
+    async def getBatchInfo(self, batch_id: str) -> dict:
+        if batch_id in self.batches:
+            return self.batches[batch_id].info()
+        if items := await self.store.getBatchItems(batch_id):
+            return summarizeBatch(batch_id, items)
 
 
     def deleteTask(self, task_id: str):
@@ -50,4 +237,8 @@ class TaskManager:
             if status == 'Error' or status == 'Done':
                 self.logger.debug(f'Deletion task with ID: {task_id}')
                 task = self.tasks.pop(task_id)
+
+                if task.batch is not None and task.batch.finished():
+                    self.logger.debug(f'Deletion batch with ID: {task.batch.id}')
+                    self.batches.pop(task.batch.id, None)
                 del task
@@ -0,0 +1,179 @@
+import logging
+import sqlite3
+import json
+import time
+import trio
+import os
+
+
+finished_statuses = ('Done', 'Error')
+
+
+class TaskStore:
+    # Queries run in worker threads, one at a time and in the order they were made, so a commit or a scan never
+    # blocks the trio loop and the single connection is never used by two threads at once
+    def __init__(self, config: dict, logger=logging.getLogger('TASK_STORE')):
+        self.logger = logger
+        self.ttl = config['STORE']['ttl']
+        self.sweep_interval = config['STORE']['sweep_interval']
+        self.limiter = trio.CapacityLimiter(1)
+
+        os.makedirs(config['MAIN']['workspace'], exist_ok=True)
+        self.path = os.path.join(config['MAIN']['workspace'], config['STORE']['file'])
+        self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                comment TEXT NOT NULL,
+                subtasks TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                client TEXT NOT NULL,
+                batch TEXT,
+                completed TEXT NOT NULL,
+                target_path TEXT NOT NULL,
+                reference_path TEXT NOT NULL,
+                stream_path TEXT NOT NULL,
+                streaming INTEGER NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                finished REAL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+            CREATE INDEX IF NOT EXISTS tasks_batch ON tasks (batch);
+            CREATE INDEX IF NOT EXISTS tasks_finished ON tasks (finished);
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                task_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                path TEXT,
+                text TEXT,
+                coalesce INTEGER NOT NULL,
+                attempts INTEGER NOT NULL,
+                created REAL NOT NULL,
+                next_attempt REAL
+            );
+            CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt);
+            CREATE INDEX IF NOT EXISTS outbox_task ON outbox (task_id);
+        ''')
+        # Kept up to date by the methods that add and delete callbacks, so the metrics gauge does not query the outbox
+        self.outbox_size = self.connection.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+        self.logger.info(f'Task store is opened at {self.path}')
+
+
+    async def run(self, func, *args):
+        return await trio.to_thread.run_sync(func, *args, limiter=self.limiter)
+
+
+    async def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return await self.run(self.connection.execute, sql, parameters)
+
+
+    async def query(self, sql: str, parameters=()) -> list:
+        return await self.run(lambda: [dict(row) for row in self.connection.execute(sql, parameters)])
+
+
+    async def save(self, task):
+        # The record is taken from the task right away, the write may happen after the task has changed again
+        now = time.time()
+        await self.execute('''
+            INSERT INTO tasks VALUES (:id, :status, :comment, :subtasks, :priority, :client, :batch, :completed,
+                                      :target_path, :reference_path, :stream_path, :streaming, :now, :now, :finished)
+            ON CONFLICT (id) DO UPDATE SET
+                status = excluded.status, comment = excluded.comment, completed = excluded.completed,
+                target_path = excluded.target_path, reference_path = excluded.reference_path,
+                stream_path = excluded.stream_path, streaming = excluded.streaming,
+                updated = excluded.updated, finished = excluded.finished
+        ''', {
+            'id': task.id,
+            'status': task.status,
+            'comment': task.comment,
+            'subtasks': json.dumps(task.subtasks),
+            'priority': task.priority,
+            'client': task.client,
+            'batch': task.batch.id if task.batch is not None else None,
+            'completed': json.dumps(task.completed),
+            'target_path': task.target_path,
+            'reference_path': task.reference_path,
+            'stream_path': task.stream_path,
+            'streaming': int(task.streaming),
+            'now': now,
+            'finished': now if task.status in finished_statuses else None
+        })
+
+
+    async def getStatus(self, task_id: str) -> str:
+        rows = await self.query('SELECT status FROM tasks WHERE id = ?', (task_id,))
+        return rows[0]['status'] if rows else None
+
+
+    async def getBatchItems(self, batch_id: str) -> list:
+        rows = await self.query('SELECT id, subtasks, status, comment FROM tasks WHERE batch = ? ORDER BY created, rowid', (batch_id,))
+        return [(row['id'], json.loads(row['subtasks'])['download']['target'], row['status'], row['comment']) for row in rows]
+
+
+    async def getUnfinished(self) -> list:
+        rows = await self.query('SELECT * FROM tasks WHERE status NOT IN (?, ?) ORDER BY created, rowid', finished_statuses)
+        return [dict(row, subtasks=json.loads(row['subtasks']), completed=json.loads(row['completed'])) for row in rows]
+
+
+    async def deleteExpired(self) -> int:
+        return (await self.execute('DELETE FROM tasks WHERE finished < ?', (time.time() - self.ttl,))).rowcount
+
+
+    async def addCallback(self, task_id: str, url: str, path: str, text: str, coalesce: bool) -> int:
+        # next_attempt stays NULL while the first delivery is in progress, so the outbox sweep does not pick the entry up
+        callback_id = (await self.execute('INSERT INTO outbox VALUES (NULL, ?, ?, ?, ?, ?, 0, ?, NULL)', (task_id, url, path, text, int(coalesce), time.time()))).lastrowid
+        self.outbox_size += 1
+        return callback_id
+
+
+    async def deleteCallbacks(self, callback_ids: list):
+        self.outbox_size -= (await self.run(self.connection.executemany, 'DELETE FROM outbox WHERE id = ?', [(callback_id,) for callback_id in callback_ids])).rowcount
+
+
+    async def rescheduleCallbacks(self, schedule: list):
+        # schedule holds (attempts, next_attempt, callback_id) tuples
+        await self.run(self.connection.executemany, 'UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?', schedule)
+
+
+    async def resetCallbacks(self) -> int:
+        # Deliveries that were in progress when the service stopped are due again
+        return (await self.execute('UPDATE outbox SET next_attempt = ? WHERE next_attempt IS NULL', (time.time(),))).rowcount
+
+
+    def claimDueCallbacksSync(self) -> list:
+        now = time.time()
+        rows = self.connection.execute('SELECT * FROM outbox WHERE next_attempt <= ? ORDER BY id', (now,)).fetchall()
+        self.connection.executemany('UPDATE outbox SET next_attempt = NULL WHERE id = ?', [(row['id'],) for row in rows])
+        return [dict(row) for row in rows]
+
+
+    async def claimDueCallbacks(self) -> list:
+        return await self.run(self.claimDueCallbacksSync)
+
+
+    async def deleteExpiredCallbacks(self, max_age: float) -> int:
+        deleted = (await self.execute('DELETE FROM outbox WHERE created < ? AND next_attempt IS NOT NULL', (time.time() - max_age,))).rowcount
+        self.outbox_size -= deleted
+        return deleted
+
+
+    async def getCallbackTasks(self) -> set:
+        return {row['task_id'] for row in await self.query('SELECT DISTINCT task_id FROM outbox')}
+
+
+    async def getCallbackPaths(self, task_ids: list) -> set:
+        rows = await self.query(f'SELECT path FROM outbox WHERE task_id IN ({", ".join("?" * len(task_ids))}) AND path IS NOT NULL', task_ids)
+        return {row['path'] for row in rows}
+
+
+    def countCallbacks(self) -> int:
+        return self.outbox_size
+
+
+    def close(self):
+        self.connection.close()
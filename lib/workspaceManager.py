@@ -0,0 +1,91 @@
+import logging
+import shutil
+import trio
+import time
+import os
+
+
+def directorySize(path: str) -> int:
+    size = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    size += entry.stat(follow_symlinks=False).st_size
+                elif entry.is_dir(follow_symlinks=False):
+                    size += directorySize(entry.path)
+    except FileNotFoundError:
+        pass
+    return size
+
+
+class WorkspaceManager:
+    # Every task owns the directory named after its ID, files at the top level of the workspace
+    # (the task store database and its journal) are never touched
+    def __init__(self, config: dict, logger=logging.getLogger('WORKSPACE')):
+        self.logger = logger
+        self.root = config['MAIN']['workspace']
+        self.quota = config['WORKSPACE']['quota_mb'] * 1024 * 1024
+        self.retention = config['WORKSPACE']['retention']
+        self.sweep_interval = config['WORKSPACE']['sweep_interval']
+        self.sizes = dict()
+
+        os.makedirs(self.root, exist_ok=True)
+
+
+    def used(self) -> int:
+        return sum(self.sizes.values())
+
+
+    def full(self) -> bool:
+        return bool(self.quota) and self.used() >= self.quota
+
+
+    def path(self, task_id: str) -> str:
+        return os.path.join(self.root, task_id)
+
+
+    async def measure(self, task_id: str):
+        self.sizes[task_id] = await trio.to_thread.run_sync(directorySize, self.path(task_id))
+
+
+    def removeFilesSync(self, task_id: str, keep: set) -> int:
+        removed = 0
+        with os.scandir(self.path(task_id)) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and os.path.abspath(entry.path) not in keep:
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
+
+
+    async def removeFiles(self, task_id: str, keep: set):
+        try:
+            removed = await trio.to_thread.run_sync(self.removeFilesSync, task_id, {os.path.abspath(path) for path in keep})
+            self.logger.debug(f'Removed {removed} files of task {task_id}')
+        except OSError as e:
+            self.logger.warning(f'Could not clean the workspace of task {task_id}: {str(e)}')
+        await self.measure(task_id)
+
+
+    def sweepSync(self, protected: set) -> (int, dict):
+        removed = 0
+        sizes = dict()
+        expired_before = time.time() - self.retention
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if entry.name not in protected and entry.stat().st_mtime < expired_before:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+                else:
+                    sizes[entry.name] = directorySize(entry.path)
+        return removed, sizes
+
+
+    async def sweep(self, protected: set) -> int:
+        # Directory sizes are recounted on every sweep, which also picks up workspaces left from before a restart
+        removed, sizes = await trio.to_thread.run_sync(self.sweepSync, protected)
+        self.sizes = sizes
+        return removed